@@ -0,0 +1,6 @@
+# python3 -m PromptSeeker, same as the promptseek command
+import sys
+
+from PromptSeeker.cli import main
+
+sys.exit(main())
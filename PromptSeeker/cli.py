@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""promptseek command
+
+promptseek run "To build FastAPI application pytest generator."
+promptseek auto "To build FastAPI application pytest generator." --max-process 5 --journal results/journals/run.jsonl
+promptseek resume results/journals/run.jsonl
+promptseek inspect-results results/results.sqlite3 --goal "To build FastAPI application pytest generator."
+
+Only the standard library is imported at start; openai, the models and the
+settings of .env are loaded by the commands calling the LLM.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+DEFAULT_SAVE_DIR = "./results/prompt_seeks/"
+
+
+def _add_llm_arguments(parser):
+    parser.add_argument("--engine", default="gpt-3.5-turbo")
+    parser.add_argument(
+        "--cache", default=None, help="ResponseCache file put in front of the API"
+    )
+    parser.add_argument(
+        "-o", "--output", help="JSONL file, or a .sqlite3/.db ResultStore of the saves"
+    )
+    parser.add_argument(
+        "--key-pool",
+        action="store_true",
+        help="share the calls over every token set in .env",
+    )
+    parser.add_argument("--moderation", choices=["inline", "batch"], default=None)
+    parser.add_argument("--batch-steps", action="store_true")
+    parser.add_argument("-q", "--quiet", action="store_true", help="do not print every response")
+
+
+def _add_seek_arguments(parser):
+    parser.add_argument("goal")
+    parser.add_argument("--max-process", type=int, default=10)
+    parser.add_argument("--journal", help="RunJournal file, see resume")
+    _add_llm_arguments(parser)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="promptseek", description="Prompt Seeking Program For automatically"
+    )
+    parser.add_argument(
+        "--env-file", default=None, help=".env file of the API keys, found upward by default"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("run", help="one iteration of a goal")
+    _add_seek_arguments(command)
+    command = commands.add_parser("auto", help="iterate a goal until it converges")
+    _add_seek_arguments(command)
+    command = commands.add_parser("resume", help="continue the run of a journal")
+    command.add_argument("journal")
+    _add_llm_arguments(command)
+
+    command = commands.add_parser(
+        "inspect-results", help="list saved runs (directory, JSONL or results store)"
+    )
+    command.add_argument("path", nargs="?", default=DEFAULT_SAVE_DIR)
+    command.add_argument("--goal", help="only the runs of this goal")
+    command.add_argument("--search", help="only the runs whose step prompts contain this")
+    command.add_argument("--limit", type=int, default=20)
+    command.add_argument(
+        "--show", action="store_true", help="print the latest matching run as JSON"
+    )
+    return parser
+
+
+def _open_sink(output):
+    if output is None:
+        return None
+    if output.endswith((".sqlite3", ".db")):
+        from PromptSeeker.modules.store import ResultStore
+
+        return ResultStore(output)
+    from PromptSeeker.modules.sink import JsonlSink
+
+    return JsonlSink(output)
+
+
+def _seek(args):
+    """run / auto / resume: the only commands importing openai"""
+    import PromptSeeker.modules.config as CONFIG
+
+    CONFIG.load(args.env_file)
+
+    from PromptSeeker.models.promptseek import PromptSeek
+    from PromptSeeker.modules.openaiwappper import OpenAIWrapper
+
+    cache = None
+    if args.cache:
+        from PromptSeeker.modules.cache import ResponseCache
+
+        cache = ResponseCache(args.cache)
+    key_pool = None
+    if args.key_pool:
+        from PromptSeeker.modules.keypool import KeyPool
+
+        key_pool = KeyPool.from_config(args.engine)
+    open_ai_wapper = OpenAIWrapper(
+        engine=args.engine, cache=cache, verbose=not args.quiet, key_pool=key_pool
+    )
+    sink = _open_sink(args.output)
+    seek_kwargs = {
+        "sink": sink,
+        "moderation": args.moderation,
+        "batch_steps": args.batch_steps,
+    }
+    try:
+        if args.command == "resume":
+            prompt_seeker = PromptSeek.from_journal(
+                args.journal, open_ai_wapper, **seek_kwargs
+            )
+            final_prompt = prompt_seeker.resume()
+        else:
+            prompt_seeker = PromptSeek(
+                goal=args.goal,
+                llm_wrapper=open_ai_wapper,
+                max_process=args.max_process,
+                journal=args.journal,
+                **seek_kwargs,
+            )
+            final_prompt = prompt_seeker.seek()
+            if args.command == "auto":
+                final_prompt = prompt_seeker.auto_seek()
+    finally:
+        if sink is not None:
+            sink.close()
+        if cache is not None:
+            cache.close()
+    print("-------------final prompt--------------")
+    print(final_prompt)
+    return 0
+
+
+def _read_results(path):
+    """Saved runs of a PromptSeek.save directory, a JSONL sink or a ResultStore, oldest first"""
+    if os.path.isdir(path):
+        for name in sorted(glob.glob(os.path.join(path, "*.json"))):
+            with open(name, encoding="utf-8") as f:
+                record = json.load(f)
+            record.setdefault("_source", os.path.basename(name))
+            yield record
+    elif path.endswith((".sqlite3", ".db")):
+        from PromptSeeker.modules.store import ResultStore
+
+        store = ResultStore(path)
+        try:
+            yield from reversed(store.runs(limit=-1))
+        finally:
+            store.close()
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _inspect(args):
+    if not os.path.exists(args.path):
+        print(f"no results at {args.path}", file=sys.stderr)
+        return 1
+    records = []
+    for record in _read_results(args.path):
+        if args.goal is not None and record.get("goal", "").strip() != args.goal.strip():
+            continue
+        if args.search is not None and not any(
+            args.search in (prompt or "") for prompt in record.get("step_prompts") or []
+        ):
+            continue
+        records.append(record)
+    if args.show:
+        if not records:
+            print("no matching run", file=sys.stderr)
+            return 1
+        print(json.dumps(records[-1], ensure_ascii=False, indent=2))
+        return 0
+    for record in records[-args.limit :]:
+        label = record.get("_id", record.get("_source", ""))
+        steps = len(record.get("decomposed_steps") or [])
+        print(f"{label}\t{record.get('process_count')}\t{steps} steps\t{record.get('goal')}")
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "inspect-results":
+        return _inspect(args)
+    return _seek(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
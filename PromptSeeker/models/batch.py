@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Run PromptSeek over many goals
+
+python3 -m PromptSeeker.models.batch goals.txt -o results/batch.jsonl --workers 16
+cat goals.txt | python3 -m PromptSeeker.models.batch - -o results/batch.jsonl
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PromptSeeker.models.promptseek import PromptSeek
+from PromptSeeker.modules.cache import ResponseCache
+from PromptSeeker.modules.keypool import KeyPool
+from PromptSeeker.modules.metrics import METRICS
+from PromptSeeker.modules.openaiwappper import OpenAIWrapper
+from PromptSeeker.modules.sink import JsonlSink
+from PromptSeeker.modules.state import SpillFile
+from PromptSeeker.modules.store import ResultStore
+
+
+def read_goals(path):
+    """Goals of a file, one per line ("-" reads stdin). JSON lines use their "goal" key"""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                yield json.loads(line)["goal"]
+            else:
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class BatchRunner(object):
+    """Run many PromptSeek concurrently on one shared OpenAIWrapper.
+
+    The wrapper (and so its rate limiter and response cache) is shared by every
+    goal, and every save goes to the same sink. Seeks run on a thread pool since
+    they spend their time waiting on the API.
+    """
+
+    def __init__(
+        self,
+        llm_wrapper: OpenAIWrapper,
+        sink,
+        workers=8,
+        mode="seek",
+        max_process=10,
+        progress_interval=10.0,
+        metrics_path=None,
+        **seek_kwargs,
+    ) -> None:
+        self.LLM = llm_wrapper
+        self.sink = sink
+        self.workers = workers
+        self.mode = mode
+        self.max_process = max_process
+        self.progress_interval = progress_interval
+        self.metrics_path = metrics_path
+        self.seek_kwargs = seek_kwargs
+        self.done = 0
+        self.failed = 0
+        self.started_at = None
+
+    def _run_goal(self, goal):
+        prompt_seek = PromptSeek(
+            goal=goal,
+            llm_wrapper=self.LLM,
+            max_process=self.max_process,
+            sink=self.sink,
+            **self.seek_kwargs,
+        )
+        if self.mode == "auto":
+            return prompt_seek.auto_seek()
+        return prompt_seek.seek()
+
+    def progress(self):
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        minutes = elapsed / 60
+        return (
+            f"{self.done} done ({self.failed} failed) in {elapsed:.0f}s, "
+            f"{self.done / minutes:.1f} goals/min, "
+            f"{self.LLM.call_count / minutes:.1f} calls/min"
+        )
+
+    def report(self):
+        print(self.progress(), file=sys.stderr)
+        if self.metrics_path:
+            METRICS.write_prometheus(self.metrics_path)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self.report()
+
+    async def run(self, goals):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        self.started_at = time.monotonic()
+
+        async def worker(executor):
+            while True:
+                goal = await queue.get()
+                try:
+                    if goal is None:
+                        return
+                    await loop.run_in_executor(executor, self._run_goal, goal)
+                except Exception as e:
+                    self.failed += 1
+                    self.sink.write({"goal": goal, "error": repr(e)})
+                finally:
+                    if goal is not None:
+                        self.done += 1
+                    queue.task_done()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            reporter = asyncio.ensure_future(self._report())
+            tasks = [
+                asyncio.ensure_future(worker(executor)) for _ in range(self.workers)
+            ]
+            # feeding through a bounded queue keeps huge goal files streaming;
+            # the goals are read off the event loop, a slow stdin would block it
+            goals = iter(goals)
+            while True:
+                goal = await loop.run_in_executor(None, next, goals, None)
+                if goal is None:
+                    break
+                await queue.put(goal)
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+            reporter.cancel()
+        self.report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run PromptSeek over many goals")
+    parser.add_argument("goals", help="file with one goal per line, - for stdin")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="./results/batch.jsonl",
+        help="JSONL file, or a .sqlite3/.db ResultStore",
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--mode", choices=["seek", "auto"], default="seek")
+    parser.add_argument("--max-process", type=int, default=10)
+    parser.add_argument("--engine", default="gpt-3.5-turbo")
+    parser.add_argument("--cache", default="./results/cache/responses.sqlite3")
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    parser.add_argument("--metrics", help="write Prometheus text metrics to this file")
+    parser.add_argument(
+        "--key-pool",
+        action="store_true",
+        help="share the calls over every token set in config.py",
+    )
+    parser.add_argument(
+        "--spill-dir", help="keep the raw responses of running seeks in a file there"
+    )
+    parser.add_argument(
+        "--warm-start", help="ResultStore whose prior runs seed similar goals"
+    )
+    args = parser.parse_args(argv)
+
+    seek_kwargs = {}
+    if args.warm_start:
+        from PromptSeeker.modules.warmstart import GoalIndex
+
+        warm_store = ResultStore(args.warm_start)
+        try:
+            # the index keeps what it needs, the store is not used afterwards
+            seek_kwargs["warm_start"] = GoalIndex.from_store(warm_store)
+        finally:
+            warm_store.close()
+
+    spill = SpillFile(dir=args.spill_dir) if args.spill_dir else None
+    if spill is not None:
+        seek_kwargs["spill"] = spill
+    cache = ResponseCache(args.cache) if args.cache else None
+    key_pool = KeyPool.from_config(args.engine) if args.key_pool else None
+    open_ai_wapper = OpenAIWrapper(
+        engine=args.engine, cache=cache, verbose=False, key_pool=key_pool
+    )
+    if args.output.endswith((".sqlite3", ".db")):
+        sink = ResultStore(args.output)
+    else:
+        sink = JsonlSink(args.output)
+    runner = BatchRunner(
+        open_ai_wapper,
+        sink,
+        workers=args.workers,
+        mode=args.mode,
+        max_process=args.max_process,
+        progress_interval=args.progress_interval,
+        metrics_path=args.metrics,
+        **seek_kwargs,
+    )
+    try:
+        asyncio.run(runner.run(read_goals(args.goals)))
+    finally:
+        sink.close()
+        if cache is not None:
+            cache.close()
+        if spill is not None:
+            spill.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,62 +1,239 @@
 # -*- coding: utf-8 -*-
-import json
+import io
+import threading
 import os
 import re
-import sys
 import time
 
-sys.path.append(os.getcwd())
-
+import PromptSeeker.modules.config as CONFIG
+from PromptSeeker.modules.convergence import NormalizedTextConvergence, normalize_step
+from PromptSeeker.modules.dedup import StepDeduplicator
+from PromptSeeker.modules.journal import RunJournal
+from PromptSeeker.modules.metrics import METRICS, Metrics
+from PromptSeeker.modules.moderation import wait as wait_moderation
 from PromptSeeker.modules.openaiwappper import OpenAIWrapper
+from PromptSeeker.modules.parser import (
+    StepPrompts,
+    parse_decomposition,
+    parse_optimization,
+    parse_redefinition,
+    parse_step_prompts,
+)
+from PromptSeeker.modules.resilience import deadline
+from PromptSeeker.modules.scheduler import run_stages, stage_dependencies
+from PromptSeeker.modules.state import RunHistory, RunState, StateAttribute, write_json
+from PromptSeeker.modules.tokens import compact_messages, count_message_tokens
+
+# a decomposition line holding a step, e.g. "- [P3]: ..." or " P3: ..."
+STEP_LINE_PATTERN = re.compile(r"^\W*P(\d+|END)\]?\s*[:=]")
+
+# attributes each stage reads and writes, in the order of one iteration.
+# Stages that do not depend on each other run at the same time (see scheduler.py)
+STAGE_IO = {
+    "decompose_goal": {
+        "reads": ("goal", "decomposed_steps"),
+        "writes": ("decomposed_steps", "variables", "plane_decomposition"),
+    },
+    "deduplicate_steps": {
+        "reads": ("decomposed_steps",),
+        "writes": ("step_groups",),
+    },
+    "optimize_variables": {
+        "reads": ("goal", "variables"),
+        "writes": ("variables_description", "plane_optimization"),
+    },
+    "redefine_goal_and_variables": {
+        "reads": ("goal", "variables", "variables_description"),
+        "writes": ("goal_contents", "variables", "plane_redefinition"),
+    },
+    "generate_step_prompts": {
+        "reads": (
+            "decomposed_steps",
+            "step_groups",
+            "generated_steps",
+            "step_prompts",
+        ),
+        "writes": (
+            "step_prompts",
+            "failed_steps",
+            "plane_step_prompts",
+            "generated_steps",
+        ),
+    },
+    "save": {
+        "reads": (),
+        "writes": (),
+        "after": (
+            "decompose_goal",
+            "deduplicate_steps",
+            "optimize_variables",
+            "redefine_goal_and_variables",
+            "generate_step_prompts",
+        ),
+    },
+}
+STAGE_ORDER = tuple(STAGE_IO)
+# decompose_goal -> (optimize_variables -> redefine_goal_and_variables
+#                   | deduplicate_steps -> generate_step_prompts) -> save
+STAGE_DEPENDENCIES = stage_dependencies(STAGE_IO, STAGE_ORDER)
+
+
+class SeekCancelled(Exception):
+    """Raised before the next stage once PromptSeek.cancel() was called"""
 
 
 class PromptSeek(object):
+    # run state, kept compact in self.state (RunState)
+    goal_contents = StateAttribute()
+    decomposed_steps = StateAttribute()
+    variables = StateAttribute()
+    variables_description = StateAttribute()
+    step_prompts = StateAttribute()
+    # first position of the group of every decomposed step, see deduplicate_steps
+    step_groups = StateAttribute()
+    # decomposed steps the step_prompts were generated for
+    generated_steps = StateAttribute()
+    failed_steps = StateAttribute()
+    process_count = StateAttribute()
+    plane_decomposition = StateAttribute()
+    plane_optimization = StateAttribute()
+    plane_redefinition = StateAttribute()
+    plane_step_prompts = StateAttribute()
+
     def __init__(
         self,
         goal,
         llm_wrapper: OpenAIWrapper,
         max_process=10,
+        step_concurrency=4,
+        stream=False,
+        on_event=None,
+        convergence=None,
+        convergence_patience=1,
+        journal=None,
+        sink=None,
+        warm_start=None,
+        warm_start_threshold=0.85,
+        token_budgets=None,
+        moderation=None,
+        parallel_stages=True,
+        batch_steps=False,
+        reuse_step_prompts=True,
+        step_deduplicator=None,
+        spill=None,
+        history_size=2,
+        stage_deadlines=None,
     ) -> None:
+        """
+        - step_concurrency : step prompts requested at once in generate_step_prompts
+        - stream : consume the stage responses as a stream
+        - on_event : callback(event, payload) notified while the stages progress,
+            "stage" carries the outputs of every completed stage
+        - convergence : callable(previous_steps, current_steps) -> bool stopping auto_seek,
+            defaults to NormalizedTextConvergence, False disables early stopping
+        - convergence_patience : converged iterations in a row before auto_seek stops
+        - journal : RunJournal (or its path) recording every completed stage, see resume
+        - sink : object with write(record) receiving every save instead of a JSON file
+        - warm_start : GoalIndex of prior runs, the first decomposition starts from the
+            closest prior goal above warm_start_threshold
+        - token_budgets : {stage: {"max_input_tokens", "max_tokens"}}, defaults to
+            CONFIG.STAGE_TOKEN_BUDGETS
+        - moderation : None, "inline" (every call waits for its own moderation) or
+            "batch" (responses are moderated in batches in the background, the
+            verdicts are awaited at save / get_final_prompt)
+        - parallel_stages : run the stages that do not depend on each other at the
+            same time, False runs them one by one in STAGE_ORDER
+        - batch_steps : ask every step prompt in one request, steps missing in the
+            answer are asked one by one
+        - reuse_step_prompts : keep the prompt of the steps whose normalized text did
+            not change since the previous iteration, only new steps are asked
+        - step_deduplicator : callable(steps) -> group of every step, one prompt is
+            generated per group; defaults to StepDeduplicator (exact and "[P#]" reference
+            duplicates), StepDeduplicator(threshold=0.9) adds near duplicates, False disables
+        - spill : SpillFile receiving the compressed raw responses instead of memory
+        - history_size : iteration snapshots kept in memory in self.history, older
+            ones go to `spill` (or are dropped without one)
+        - stage_deadlines : {stage: seconds} the calls of a stage have to finish in,
+            defaults to CONFIG.STAGE_DEADLINES
+        """
         self.LLM = llm_wrapper
         self.goal = goal
         self.max_process = max_process
-        self.goal_contents = []
-        self.decomposed_steps = []
-        self.variables = []
-        self.variables_description = {}
-        self.step_prompts = []
-        self.process_count = 0
-        self.plane_optimization = ""
-        self.plane_decomposition = ""
-        self.plane_redefinition = ""
-        self.plane_step_prompts = ""
+        self.step_concurrency = step_concurrency
+        self.stream = stream
+        self.on_event = on_event
+        if convergence is None:
+            convergence = NormalizedTextConvergence()
+        self.convergence = convergence or None
+        self.convergence_patience = convergence_patience
+        if isinstance(journal, str):
+            journal = RunJournal(journal)
+        self.journal = journal
+        self.sink = sink
+        self.warm_start = warm_start
+        self.warm_start_threshold = warm_start_threshold
+        self.warm_start_goal = None
+        if token_budgets is None:
+            token_budgets = CONFIG.STAGE_TOKEN_BUDGETS
+        self.token_budgets = token_budgets
+        if stage_deadlines is None:
+            stage_deadlines = CONFIG.STAGE_DEADLINES
+        self.stage_deadlines = stage_deadlines
+        if moderation not in (None, "inline", "batch"):
+            raise ValueError(f"unknown moderation mode {moderation!r}")
+        self.moderation = moderation
+        self._moderation_pending = []
+        self.parallel_stages = parallel_stages
+        self.batch_steps = batch_steps
+        self.reuse_step_prompts = reuse_step_prompts
+        if step_deduplicator is None:
+            step_deduplicator = StepDeduplicator()
+        self.step_deduplicator = step_deduplicator or None
+        # stage / LLM call timings of this run, also fed to the process wide METRICS
+        self.metrics = Metrics(parent=METRICS)
+        # resume position: stages of the current iteration already completed
+        self._done_stages = set()
+        # resumed after a generate_step_prompts pass with failed steps: ask only those
+        self._retry_failed_steps = False
+        self._resume_mode = None
+        self._resuming = False
+        self._finished = False
+        self._cancelled = threading.Event()
+        self.state = RunState(spill=spill)
+        # snapshots of the completed iterations
+        self.history = RunHistory(keep=history_size, spill=spill)
+
+    def iter_items(self):
+        """(key, value) of to_dict, each raw response decompressed only when reached"""
+        yield "goal", self.goal
+        yield "goal_contents", self.goal_contents
+        yield "decomposed_steps", self.decomposed_steps
+        yield "plane_decomposed_steps", self.plane_decomposition
+        yield "variables", self.variables
+        yield "plane_optimization", self.plane_optimization
+        yield "variables_description", self.variables_description
+        yield "plane_redefinition", self.plane_redefinition
+        yield "step_prompts", self.step_prompts
+        yield "plane_step_prompts", self.plane_step_prompts
+        yield "process_count", self.process_count
 
     def to_dict(self):
-        return {
-            "goal": self.goal,
-            "goal_contents": self.goal_contents,
-            "decomposed_steps": self.decomposed_steps,
-            "plane_decomposed_steps": self.plane_decomposition,
-            "variables": self.variables,
-            "plane_optimization": self.plane_optimization,
-            "variables_description": self.variables_description,
-            "plane_redefinition": self.plane_redefinition,
-            "step_prompts": self.step_prompts,
-            "plane_step_prompts": self.plane_step_prompts,
-            "process_count": self.process_count,
-        }
+        return dict(self.iter_items())
 
-    def to_formated_text(self):
-        formated_text = ""
-        for k, v in self.to_dict().items():
+    def write_formated_text(self, f):
+        for k, v in self.iter_items():
             if "plane" in k:
                 continue
-            if type(v) == list:
+            if isinstance(v, (list, tuple)):
                 flatten_v = "\n".join(v)
             else:
                 flatten_v = v
-            formated_text += f"{k}:\n{flatten_v}\n\n"
-        return formated_text
+            f.write(f"{k}:\n{flatten_v}\n\n")
+
+    def to_formated_text(self):
+        formated_text = io.StringIO()
+        self.write_formated_text(formated_text)
+        return formated_text.getvalue()
 
     def save(
         self,
@@ -64,6 +241,18 @@ class PromptSeek(object):
         save_name="prompt_seek.json",
         with_goal=True,
     ):
+        self._wait_moderation()
+
+        def record():
+            yield from self.iter_items()
+            yield "metrics", self.metrics.summary()
+
+        if self.sink is not None:
+            if hasattr(self.sink, "write_items"):
+                self.sink.write_items(record())
+            else:
+                self.sink.write(dict(record()))
+            return
         os.makedirs(save_dir, exist_ok=True)
         now = time.strftime("%Y%m%d%H%M%S", time.localtime())
         if with_goal:
@@ -71,31 +260,255 @@ class PromptSeek(object):
         else:
             save_path = save_dir + now + save_name
         with open(save_path, "w") as f:
-            json.dump(self.to_dict(), f)
+            write_json(record(), f)
 
     def seek(self):
-        self.decompose_goal()
-        self.optimize_variables()
-        self.redefine_goal_and_variables()
-        self.generate_step_prompts()
-        self.save()
+        self._journal_start("seek", max_process=self.max_process)
+        self._run_iteration()
+        self._journal_event("finished")
         return self.get_final_prompt()
 
     def auto_seek(self, max_process=None):
         if max_process is None:
             max_process = self.max_process
-        self.decompose_goal()
-        self.optimize_variables()
-        self.redefine_goal_and_variables()
-        self.generate_step_prompts()
-        self.save()
-        # base case: reached maximum number of processes
-        if max_process is not None and self.process_count >= max_process:
+        self._journal_start("auto_seek", max_process=max_process)
+        stable_count = 0
+        while True:
+            if "decompose_goal" not in self._done_stages:
+                previous = (
+                    self.decomposed_steps,
+                    self.variables,
+                    self.plane_decomposition,
+                )
+                # only a brushup of the previous steps can converge: the first
+                # decomposition asked again (e.g. auto_seek after seek) repeats
+                # the same request and would match trivially
+                brushup = self._is_brushup()
+                self._run_stage("decompose_goal")
+                if brushup and previous[0] and self._is_converged(previous[0]):
+                    stable_count += 1
+                    if stable_count >= self.convergence_patience:
+                        # the rest of the iteration would reproduce the previous one
+                        self.decomposed_steps, self.variables, self.plane_decomposition = previous
+                        print(f"converged at process {self.process_count}")
+                        self._emit("converged", {"process_count": self.process_count})
+                        self._journal_event(
+                            "finished",
+                            outputs=self._stage_outputs("decompose_goal"),
+                        )
+                        return self.get_final_prompt()
+                else:
+                    stable_count = 0
+            self._run_iteration()
+            # reached maximum number of processes
+            if max_process is not None and self.process_count >= max_process:
+                self._journal_event("finished")
+                return self.get_final_prompt()
+            self.process_count += 1
+
+    def _run_iteration(self):
+        """Run the stages of one iteration not completed yet"""
+        if self.parallel_stages:
+            run_stages(
+                STAGE_ORDER, STAGE_DEPENDENCIES, self._run_stage, done=self._done_stages
+            )
+        else:
+            for stage in STAGE_ORDER:
+                if stage not in self._done_stages:
+                    self._run_stage(stage)
+        self._done_stages = set()
+        self.history.append(self.state.snapshot())
+
+    def cancel(self):
+        """Stop the run before its next stage (SeekCancelled), the running stage completes"""
+        self._cancelled.set()
+
+    def _run_stage(self, stage):
+        if self._cancelled.is_set():
+            raise SeekCancelled(f"cancelled before {stage}")
+        if self.journal is not None:
+            inputs = {k: getattr(self, k) for k in STAGE_IO[stage]["reads"]}
+        with self.metrics.activate(), self.metrics.span(
+            "promptseek_stage_seconds", stage=stage
+        ), deadline(self.stage_deadlines.get(stage)):
+            getattr(self, stage)()
+        if self.journal is not None:
+            self._journal_event(
+                "stage",
+                stage=stage,
+                inputs=inputs,
+                outputs=self._stage_outputs(stage),
+            )
+        self._done_stages.add(stage)
+        if self.on_event is not None:
+            self._emit(
+                "stage",
+                {
+                    "stage": stage,
+                    "process_count": self.process_count,
+                    "outputs": self._stage_outputs(stage),
+                },
+            )
+
+    def _stage_outputs(self, stage):
+        return {k: getattr(self, k) for k in STAGE_IO[stage]["writes"]}
+
+    def _journal_event(self, event, **record):
+        if self.journal is not None:
+            self.journal.append(
+                dict(record, event=event, process_count=self.process_count)
+            )
+
+    def _journal_start(self, mode, max_process):
+        if self._resuming:
+            self._resuming = False
+            self._journal_event("resume", mode=mode)
+        else:
+            self._journal_event(
+                "start", mode=mode, goal=self.goal, max_process=max_process
+            )
+
+    @classmethod
+    def from_journal(cls, journal, llm_wrapper, **kwargs):
+        """Rebuild a PromptSeek from its journal, ready to resume()"""
+        if isinstance(journal, str):
+            journal = RunJournal(journal)
+        records = journal.read()
+        starts = [i for i, r in enumerate(records) if r["event"] == "start"]
+        if not starts:
+            raise ValueError(f"no run recorded in {journal.path}")
+        start = records[starts[-1]]
+        prompt_seek = cls(
+            goal=start["goal"],
+            llm_wrapper=llm_wrapper,
+            max_process=start["max_process"],
+            journal=journal,
+            **kwargs,
+        )
+        # replay every completed stage, the run may continue an earlier seek
+        for record in records:
+            for k, v in record.get("outputs", {}).items():
+                setattr(prompt_seek, k, v)
+            prompt_seek.process_count = record["process_count"]
+
+        prompt_seek._resume_mode = start["mode"]
+        current = records[starts[-1] :]
+        stages = [r["stage"] for r in current if r["event"] == "stage"]
+        if any(r["event"] == "finished" for r in current):
+            prompt_seek._finished = True
+        elif stages:
+            # stages complete in any order, the iteration ends with its save
+            last_save = max(
+                (i for i, stage in enumerate(stages) if stage == "save"), default=-1
+            )
+            done_stages = set(stages[last_save + 1 :])
+            if "generate_step_prompts" in done_stages and prompt_seek.failed_steps:
+                # the steps that failed have no prompt yet, run the stage again for them
+                done_stages.discard("generate_step_prompts")
+                prompt_seek._retry_failed_steps = True
+            if done_stages:
+                prompt_seek._done_stages = done_stages
+            elif (
+                start["mode"] == "auto_seek"
+                and prompt_seek.process_count < start["max_process"]
+            ):
+                prompt_seek.process_count += 1
+            else:
+                prompt_seek._finished = True
+        return prompt_seek
+
+    def resume(self):
+        """Continue a run rebuilt by from_journal from its first unfinished stage"""
+        if self._finished:
             return self.get_final_prompt()
+        self._resuming = True
+        if self._resume_mode == "auto_seek":
+            return self.auto_seek(self.max_process)
+        return self.seek()
+
+    def _is_brushup(self):
+        """Whether decompose_goal sends the previous steps to be brushed up"""
+        return self.process_count > 0 or self.warm_start_goal is not None
+
+    def _is_converged(self, previous_steps):
+        if self.convergence is None:
+            return False
+        return self.convergence(previous_steps, self.decomposed_steps)
+
+    def _emit(self, event, payload):
+        if self.on_event is not None:
+            self.on_event(event, payload)
+
+    def _ask(self, stage, prompt, on_line=None):
+        """Ask the LLM for a stage, through the stream when enabled.
 
-        # recursive case: continue calling function
-        self.process_count += 1
-        return self.auto_seek(max_process)
+        on_line is called with every completed line while streaming.
+        """
+        prompt, params = self._budget(stage, prompt)
+        if self.moderation == "inline":
+            params["use_common_moderation"] = True
+        if not self.stream:
+            content = self.LLM.ask(prompt=prompt, **params)
+            self._moderate([content])
+            return content
+
+        response = self.LLM.ask(prompt=prompt, stream=True, **params)
+        buffer = ""
+        first = True
+        for delta in response:
+            if first:
+                first = False
+                self._emit("first_token", {"stage": stage, "ttft": response.ttft})
+            if on_line is None:
+                continue
+            buffer += delta
+            if "\n" in buffer:
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    on_line(line)
+        if on_line is not None and buffer:
+            on_line(buffer)
+        self._moderate([response.content])
+        return response.content
+
+    def _moderate(self, texts):
+        """Queue responses for background moderation in "batch" mode"""
+        if self.moderation == "batch" and texts:
+            self._moderation_pending.extend(self.LLM.moderation_batcher.submit(texts))
+
+    def _wait_moderation(self):
+        """Block until the queued verdicts are in, raise ModerationError on a violation"""
+        pending, self._moderation_pending = self._moderation_pending, []
+        with self.metrics.activate(), self.metrics.span(
+            "promptseek_moderation_wait_seconds"
+        ):
+            wait_moderation(pending)
+
+    def _budget(self, stage, prompt):
+        """Compact a stage prompt to its token budget, returns (prompt, ask params)"""
+        budget = self.token_budgets.get(stage) or {}
+        if budget.get("max_input_tokens"):
+            prompt = compact_messages(
+                prompt, budget["max_input_tokens"], engine=self.LLM.engine
+            )
+        params = {}
+        if budget.get("max_tokens"):
+            # leave the completion what the prompt does not use of the context
+            context = CONFIG.CONTEXT_WINDOWS.get(
+                self.LLM.engine, CONFIG.CONTEXT_WINDOWS["default"]
+            )
+            left = context - count_message_tokens(prompt, self.LLM.engine)
+            params["max_tokens"] = max(1, min(budget["max_tokens"], left))
+        return prompt, params
+
+    def _on_decomposition_line(self, line):
+        """Emit a P# step as soon as its line is complete"""
+        match = STEP_LINE_PATTERN.search(line)
+        if match:
+            self._emit(
+                "decomposition_step",
+                {"step_id": match.group(1), "text": line.strip()},
+            )
 
     def get_prompt_seek_rules(self):
         return self.LLM.ask(prompt="What are the rules of the prompt seek method?")
@@ -128,7 +541,9 @@ class PromptSeek(object):
         first_dummy_prompt = (
             f"I want to decompose the goal {self.goal} into a list of prompts"
         )
-        if self.process_count == 0:
+        if self.process_count == 0 and not self.decomposed_steps:
+            self._warm_start()
+        if not self._is_brushup():
             dummy_user_prompt = first_dummy_prompt
             previous_decomposition = ("").join(
                 [
@@ -159,18 +574,35 @@ class PromptSeek(object):
                 + _prev
             )
 
-        decomposition = self.LLM.ask(
-            prompt=[
+        decomposition = self._ask(
+            "decompose_goal",
+            [
                 {"role": "system", "content": decomposition_rule},
                 {"role": "user", "content": first_dummy_prompt},
                 {"role": "assistant", "content": previous_decomposition},
                 {"role": "user", "content": dummy_user_prompt},
-            ]
+            ],
+            on_line=self._on_decomposition_line,
         )
         steps, variables = self._parse_decomposition(decomposition)
         self.decomposed_steps = steps
         self.variables = variables
 
+    def _warm_start(self):
+        """Seed decomposed_steps with the closest prior run, as if it were a later iteration"""
+        if self.warm_start is None:
+            return
+        found = self.warm_start.lookup(self.goal, threshold=self.warm_start_threshold)
+        if found is None:
+            return
+        similarity, record = found
+        self.decomposed_steps = list(record["decomposed_steps"])
+        self.warm_start_goal = record["goal"]
+        print(f"warm start from {self.warm_start_goal!r} (similarity {similarity:.3f})")
+        self._emit(
+            "warm_start", {"goal": self.warm_start_goal, "similarity": similarity}
+        )
+
     def optimize_variables(self):
         """Optimize the variables
         - [C2] :
@@ -221,8 +653,9 @@ class PromptSeek(object):
                 ]
             )
 
-        optimization = self.LLM.ask(
-            prompt=[
+        optimization = self._ask(
+            "optimize_variables",
+            [
                 {"role": "system", "content": optimization_rule},
                 {"role": "user", "content": first_dummy_prompt},
                 {"role": "assistant", "content": previous_decomposition},
@@ -257,8 +690,9 @@ class PromptSeek(object):
         previous_results = ("").join(prev_) if len(prev_) > 0 else ""
 
         dummy_user_prompt = "Please help me redefine the goal and update the variables."
-        redefinition = self.LLM.ask(
-            prompt=[
+        redefinition = self._ask(
+            "redefine_goal_and_variables",
+            [
                 {"role": "system", "content": redefinition_rule},
                 {"role": "user", "content": first_dummy_prompt},
                 {"role": "assistant", "content": previous_results},
@@ -312,10 +746,11 @@ class PromptSeek(object):
         else:
             previous_results = "No decomposed steps"
 
+        prompts = []
         for step_id, step in enumerate(self.decomposed_steps):
             step_id = step_id if step_id < len(self.decomposed_steps) else "END"
-            step_prompt = self.LLM.ask(
-                prompt=[
+            prompts.append(
+                [
                     {"role": "system", "content": generation_rule},
                     {"role": "user", "content": first_dummy_prompt},
                     {"role": "assistant", "content": previous_results},
@@ -325,10 +760,122 @@ class PromptSeek(object):
                     },
                 ]
             )
-            self.step_prompts.append(step_prompt)
+
+        results = [None] * len(prompts)
+        groups = self.step_groups
+        if len(groups) != len(prompts):
+            groups = list(range(len(prompts)))
+        if self._retry_failed_steps and list(self.generated_steps) == list(
+            self.decomposed_steps
+        ):
+            # resumed pass: keep the prompts of the steps that succeeded
+            failed = set(self.failed_steps)
+            for step_id, prompt in enumerate(self.step_prompts):
+                if step_id not in failed and groups[step_id] == step_id:
+                    results[step_id] = prompt
+        elif self.reuse_step_prompts:
+            # steps unchanged since the previous iteration keep their prompt
+            # steps normalized to nothing (e.g. "- [P0]") say nothing to match on
+            previous = {
+                normalize_step(step): prompt
+                for step, prompt in zip(self.generated_steps, self.step_prompts)
+                if prompt and normalize_step(step)
+            }
+            for step_id, step in enumerate(self.decomposed_steps):
+                text = normalize_step(step)
+                if groups[step_id] == step_id and text:
+                    results[step_id] = previous.get(text)
+            reused = len(results) - results.count(None)
+            if reused:
+                print(f"{reused}/{len(results)} step prompts unchanged")
+                self.metrics.inc("promptseek_step_prompts_reused_total", reused)
+        # duplicates take the prompt of the first step of their group
+        wanted = [
+            i for i, result in enumerate(results) if result is None and groups[i] == i
+        ]
+
+        if self.batch_steps and len(wanted) > 1:
+            batched_prompt = [
+                {"role": "system", "content": generation_rule},
+                {"role": "user", "content": first_dummy_prompt},
+                {"role": "assistant", "content": previous_results},
+                {
+                    "role": "user",
+                    "content": "".join(
+                        [
+                            "Please help me generate the step prompts of these steps at once.\n",
+                            "Answer only with a python dict whose keys are ",
+                            ", ".join(f'"O{i}"' for i in wanted),
+                            " and whose values are the step prompts.",
+                        ]
+                    ),
+                },
+            ]
+            # errors of the request itself (deadline, breaker, moderation ...) propagate,
+            # only an unreadable answer falls back to asking the steps one by one
+            self.plane_step_prompts = self._ask(
+                "generate_step_prompts_batched", batched_prompt
+            )
+            try:
+                parsed = parse_step_prompts(self.plane_step_prompts, len(prompts))
+            except (ValueError, TypeError, SyntaxError) as e:
+                print(f"batched answer unreadable: {e!r}")
+                parsed = StepPrompts({})
+            for step_id, prompt in parsed.prompts.items():
+                if step_id in wanted:
+                    results[step_id] = prompt
+        else:
+            # no batched answer in this iteration
+            self.plane_step_prompts = ""
+        missing = [i for i in wanted if results[i] is None]
+        if self.batch_steps and len(wanted) > 1 and missing:
+            print(f"steps {missing} missing in the batched answer, asking one by one")
+
+        budgeted = [self._budget("generate_step_prompts", prompts[i]) for i in missing]
+        params = budgeted[0][1] if budgeted else {}
+        if self.moderation == "inline":
+            params["use_common_moderation"] = True
+        # fan out all remaining steps at once, results come back in step order
+        answers = self.LLM.ask_many(
+            [p for p, _ in budgeted], concurrency=self.step_concurrency, **params
+        )
+        for step_id, answer in zip(missing, answers):
+            results[step_id] = answer
+        for step_id, group in enumerate(groups):
+            results[step_id] = results[group]
+        # one prompt per step of the current decomposition
+        failed_steps = []
+        step_prompts = []
+        for step_id, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f"step {step_id} failed: {result!r}")
+                failed_steps.append(step_id)
+                result = ""
+            step_prompts.append(result)
+        self.failed_steps = failed_steps
+        self._retry_failed_steps = False
+        self.step_prompts = step_prompts
+        self.generated_steps = list(self.decomposed_steps)
+        if results and len(self.failed_steps) == len(results):
+            raise results[0]
+        # every step prompt asked one by one goes in one moderation request,
+        # the batched answer was moderated as a whole
+        self._moderate([a for a in answers if isinstance(a, str) and a])
+
+    def deduplicate_steps(self):
+        """Group the duplicate steps, generate_step_prompts asks once per group"""
+        if self.step_deduplicator is None:
+            self.step_groups = list(range(len(self.decomposed_steps)))
+            return
+        self.step_groups = list(self.step_deduplicator(self.decomposed_steps))
+        duplicates = sum(1 for i, group in enumerate(self.step_groups) if group != i)
+        if duplicates:
+            print(f"{duplicates}/{len(self.step_groups)} steps are duplicates")
+            self.metrics.inc("promptseek_step_duplicates_total", duplicates)
 
     ### 移植前
     def get_final_prompt(self):
+        self._wait_moderation()
         return ("\n").join(self.step_prompts)
 
     # def _parse_decomposition(self, decomposition: str):
@@ -351,90 +898,15 @@ class PromptSeek(object):
 
     def _parse_decomposition(self, decomposition: str):
         self.plane_decomposition = decomposition
-
-        # case 1 :json format
-        try:
-            data = json.loads(decomposition)
-            steps = data.get("steps", [])
-            variables = data.get("variables", [])
-        # case 2 : string format (regular expression)
-        except:
-            # Regular expressions to match steps and their descriptions in the decomposition
-            step_pattern = re.compile(r" P(?:\d+|END): (.*?)\n", re.MULTILINE)
-            description_pattern = re.compile(
-                r" P(?:\d+|END): .*?\n(.*?)(?=\n P(?:\d+|END)|$)",
-                re.MULTILINE | re.DOTALL,
-            )
-
-            steps = step_pattern.findall(decomposition)
-            descriptions = [
-                desc.strip() for desc in description_pattern.findall(decomposition)
-            ]
-
-            variables = dict(zip(steps, descriptions))
-
-        # case 3 : not json format, not string format
-        if not steps or not variables:
-            lines = decomposition.strip().split("\n")
-            steps = []
-            variables = []
-            mode = ""
-            for l in lines:
-                # decomposition returns
-                # - deocomposition step summary
-                #    - [Output] : [P#] : description
-                if "- " in l and ":" in l:
-                    _l = l.split(":")
-                    step, description = _l[-2], _l[-1]
-                    if mode != "-to[":
-                        steps.append(step.strip())
-                    variables.append(description.strip())
-                elif "- " in l:
-                    if not steps:
-                        mode = "-to["
-
-                    if mode == "-to[":
-                        steps.append(l.replace("- ", "").strip())
-                    else:
-                        variables.append(l.replace("- ", "").strip())
-
-        # case4 : not json format, not string format, not regular expression
-        if not steps or not variables:
-            steps = [l for l in decomposition.strip().split("\n")[1]]
-            variables = [l for l in decomposition.strip().split("\n")[2:]]
-        return steps, variables
+        return parse_decomposition(decomposition)
 
     def _parse_optimization(self, optimization: str):
         self.plane_optimization = optimization
-        try:
-            data = json.loads(optimization)
-            variables_description = data.get("variables_description", {})
-        except:
-            lines = optimization.strip().split("\n")
-            variables_description = {}
-            for line in lines:
-                if line.startswith("[V"):
-                    var_name, description = line.split(":", 1)
-                    variables_description[var_name.strip()] = description.strip()
-        return variables_description
+        return parse_optimization(optimization).variables_description
 
     def _parse_redefinition(self, redefinition: str):
         self.plane_redefinition = redefinition
-        try:
-            data = json.loads(redefinition)
-            goal_contents = data.get("goal_contents", "")
-            variables = data.get("variables", [])
-        except:
-            lines = redefinition.strip().split("\n")
-            goal_contents = []
-            variables = []
-            for line in lines:
-                if line.startswith("[Goal"):
-                    goal_contents.append(line)
-                elif line.startswith("[V"):
-                    variables.append(line)
-        return goal_contents, variables
-
+        return parse_redefinition(redefinition)
 
 if __name__ == "__main__":
     goal = "To build FastAPI application pytest generator."
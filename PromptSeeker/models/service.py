@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""Local job service running PromptSeek for many clients from one warm process
+
+python3 -m PromptSeeker.models.service --port 8080 --workers 4 -o results/results.sqlite3
+
+curl -X POST localhost:8080/jobs -d '{"goal": "To build FastAPI application pytest generator.", "priority": 5}'
+curl localhost:8080/jobs/<id>
+curl -N localhost:8080/jobs/<id>/events    # one JSON line per event until the job ends
+curl -X DELETE localhost:8080/jobs/<id>    # cancel
+curl localhost:8080/metrics
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from PromptSeeker.models.promptseek import PromptSeek, SeekCancelled
+from PromptSeeker.modules.cache import ResponseCache
+from PromptSeeker.modules.keypool import KeyPool
+from PromptSeeker.modules.metrics import METRICS
+from PromptSeeker.modules.openaiwappper import OpenAIWrapper
+from PromptSeeker.modules.sink import JsonlSink
+from PromptSeeker.modules.store import ResultStore
+
+FINAL_STATUSES = ("done", "failed", "cancelled")
+
+
+class Job(object):
+    """One submitted goal, its status and the events of its run.
+
+    Events are numbered so a client streaming /events can resume with ?after=.
+    """
+
+    def __init__(self, goal, mode="seek", max_process=10, priority=0, max_events=1000):
+        self.id = uuid.uuid4().hex
+        self.goal = goal
+        self.mode = mode
+        self.max_process = max_process
+        self.priority = priority
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.prompt_seek = None
+        self.events = deque(maxlen=max_events)
+        self._sequence = itertools.count()
+        self._changed = asyncio.Event()
+
+    def publish(self, event, payload=None):
+        """Record an event, must run on the event loop"""
+        self.events.append(
+            {"seq": next(self._sequence), "event": event, "payload": payload}
+        )
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def set_status(self, status, **payload):
+        self.status = status
+        if status == "running":
+            self.started_at = time.time()
+        elif status in FINAL_STATUSES:
+            self.finished_at = time.time()
+        self.publish("status", dict(payload, status=status))
+
+    @property
+    def finished(self):
+        return self.status in FINAL_STATUSES
+
+    @property
+    def changed(self):
+        """asyncio.Event set by the next event"""
+        return self._changed
+
+    def to_dict(self, with_result=True):
+        record = {
+            "id": self.id,
+            "goal": self.goal,
+            "mode": self.mode,
+            "priority": self.priority,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+        if with_result:
+            record["result"] = self.result
+        return record
+
+
+class JobService(object):
+    """Bounded priority queue of Jobs run by `workers` threads on one shared OpenAIWrapper.
+
+    - queue_size : queued jobs accepted, submit() raises asyncio.QueueFull beyond it;
+        cancelled jobs waiting to be skipped by a worker do not count
+    - max_finished : finished jobs kept for polling, the oldest are forgotten
+    - seek_kwargs : passed to every PromptSeek (sink, moderation, batch_steps ...)
+    """
+
+    def __init__(
+        self,
+        llm_wrapper: OpenAIWrapper,
+        workers=4,
+        queue_size=100,
+        max_finished=1000,
+        **seek_kwargs,
+    ) -> None:
+        self.LLM = llm_wrapper
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_finished = max_finished
+        self.seek_kwargs = seek_kwargs
+        self.jobs = OrderedDict()
+        self._order = itertools.count()
+        self._queue = None
+        # queued jobs not cancelled, what queue_size bounds
+        self._pending = 0
+        self._tasks = []
+        self._executor = None
+        self._loop = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.PriorityQueue()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="promptseek-job"
+        )
+        self._tasks = [
+            asyncio.ensure_future(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        for job in self.jobs.values():
+            if not job.finished:
+                self.cancel(job.id)
+        # the running seeks stop before their next stage; wait for them off the
+        # event loop so the workers still record their final status
+        await self._loop.run_in_executor(None, self._executor.shutdown)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def submit(self, goal, mode="seek", max_process=10, priority=0):
+        """Queue a goal, higher priorities run first. Raises asyncio.QueueFull"""
+        if self._pending >= self.queue_size:
+            raise asyncio.QueueFull
+        job = Job(goal, mode=mode, max_process=max_process, priority=priority)
+        self._queue.put_nowait((-priority, next(self._order), job))
+        self._pending += 1
+        self.jobs[job.id] = job
+        job.publish("status", {"status": "queued"})
+        METRICS.inc("promptseek_jobs_submitted_total")
+        self._forget_finished()
+        return job
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or stop a running one before its next stage"""
+        job = self.jobs[job_id]
+        if job.status == "queued":
+            # skipped by the worker that pops it
+            self._pending -= 1
+            job.set_status("cancelled")
+        elif job.status == "running" and job.prompt_seek is not None:
+            job.prompt_seek.cancel()
+            job.publish("cancelling")
+        return job
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def queued(self):
+        return self._pending
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.status == "queued":
+                    self._pending -= 1
+                    await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job):
+        loop = self._loop
+
+        def on_event(event, payload):
+            # called from the seek threads
+            loop.call_soon_threadsafe(job.publish, event, payload)
+
+        job.prompt_seek = PromptSeek(
+            goal=job.goal,
+            llm_wrapper=self.LLM,
+            max_process=job.max_process,
+            on_event=on_event,
+            **self.seek_kwargs,
+        )
+        job.set_status("running")
+        started_at = time.monotonic()
+        try:
+            if job.mode == "auto":
+                run = job.prompt_seek.auto_seek
+            else:
+                run = job.prompt_seek.seek
+            job.result = await loop.run_in_executor(self._executor, run)
+        except SeekCancelled:
+            job.set_status("cancelled")
+        except Exception as e:
+            job.error = repr(e)
+            job.set_status("failed", error=job.error)
+        else:
+            job.set_status("done")
+        finally:
+            METRICS.observe(
+                "promptseek_job_seconds",
+                time.monotonic() - started_at,
+                status=job.status,
+            )
+            # the run state is only needed while the job runs
+            job.prompt_seek = None
+
+
+def _json_response(data, status=200, **kwargs):
+    return web.json_response(
+        data, status=status, dumps=lambda d: json.dumps(d, ensure_ascii=False), **kwargs
+    )
+
+
+def make_app(service: JobService):
+    """aiohttp application serving the JobService"""
+    routes = web.RouteTableDef()
+
+    @routes.post("/jobs")
+    async def submit(request):
+        try:
+            body = await request.json()
+            goal = body["goal"].strip()
+            mode = body.get("mode", "seek")
+            max_process = int(body.get("max_process", 10))
+            priority = int(body.get("priority", 0))
+        except (ValueError, KeyError, AttributeError, TypeError) as e:
+            return _json_response({"error": f"bad request: {e!r}"}, status=400)
+        if not goal or mode not in ("seek", "auto"):
+            return _json_response(
+                {"error": "goal and mode seek|auto needed"}, status=400
+            )
+        try:
+            job = service.submit(goal, mode, max_process, priority)
+        except asyncio.QueueFull:
+            # backpressure: the client retries later
+            METRICS.inc("promptseek_jobs_rejected_total")
+            return _json_response(
+                {"error": "queue full"}, status=429, headers={"Retry-After": "5"}
+            )
+        return _json_response(job.to_dict(with_result=False), status=202)
+
+    @routes.get("/jobs")
+    async def list_jobs(request):
+        return _json_response(
+            {
+                "queued": service.queued(),
+                "jobs": [
+                    job.to_dict(with_result=False) for job in service.jobs.values()
+                ],
+            }
+        )
+
+    def get_job(request):
+        job = service.jobs.get(request.match_info["job_id"])
+        if job is None:
+            raise web.HTTPNotFound(text="unknown job")
+        return job
+
+    @routes.get("/jobs/{job_id}")
+    async def status(request):
+        return _json_response(get_job(request).to_dict())
+
+    @routes.delete("/jobs/{job_id}")
+    async def cancel(request):
+        job = service.cancel(get_job(request).id)
+        return _json_response(job.to_dict(with_result=False))
+
+    @routes.get("/jobs/{job_id}/events")
+    async def events(request):
+        """Events as JSON lines, the past ones after ?after=seq then live until the end"""
+        job = get_job(request)
+        after = int(request.query.get("after", -1))
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        while True:
+            changed = job.changed
+            for event in list(job.events):
+                if event["seq"] > after:
+                    after = event["seq"]
+                    line = json.dumps(event, ensure_ascii=False) + "\n"
+                    await response.write(line.encode("utf-8"))
+            if job.finished:
+                break
+            await changed.wait()
+        await response.write_eof()
+        return response
+
+    @routes.get("/metrics")
+    async def metrics(request):
+        return web.Response(text=METRICS.to_prometheus(), content_type="text/plain")
+
+    @routes.get("/health")
+    async def health(request):
+        return _json_response({"status": "ok", "queued": service.queued()})
+
+    app = web.Application()
+    app.add_routes(routes)
+
+    async def on_startup(app):
+        await service.start()
+
+    async def on_cleanup(app):
+        await service.stop()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve PromptSeek jobs over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument(
+        "-o", "--output", help="JSONL file, or a .sqlite3/.db ResultStore of the saves"
+    )
+    parser.add_argument("--engine", default="gpt-3.5-turbo")
+    parser.add_argument("--cache", default="./results/cache/responses.sqlite3")
+    parser.add_argument(
+        "--key-pool",
+        action="store_true",
+        help="share the calls over every token set in config.py",
+    )
+    args = parser.parse_args(argv)
+
+    cache = ResponseCache(args.cache) if args.cache else None
+    key_pool = KeyPool.from_config(args.engine) if args.key_pool else None
+    open_ai_wapper = OpenAIWrapper(
+        engine=args.engine, cache=cache, verbose=False, key_pool=key_pool
+    )
+    seek_kwargs = {}
+    sink = None
+    if args.output:
+        if args.output.endswith((".sqlite3", ".db")):
+            sink = ResultStore(args.output)
+        else:
+            sink = JsonlSink(args.output)
+        seek_kwargs["sink"] = sink
+    service = JobService(
+        open_ai_wapper,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        **seek_kwargs,
+    )
+    try:
+        web.run_app(make_app(service), host=args.host, port=args.port)
+    finally:
+        if sink is not None:
+            sink.close()
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+## Response cache for OpenAIWrapper
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheMissError(KeyError):
+    """Raised in cache-only mode when a request has no stored response"""
+
+
+def normalize_messages(messages):
+    """Keep only role/content of each message with surrounding spaces stripped"""
+    if isinstance(messages, str):
+        return messages.strip()
+    return [
+        {"role": m.get("role", ""), "content": (m.get("content") or "").strip()}
+        for m in messages
+    ]
+
+
+def make_key(engine, messages, params=None):
+    """Content address of a request: engine + normalized messages + sampling params"""
+    payload = json.dumps(
+        {
+            "engine": engine,
+            "messages": normalize_messages(messages),
+            "params": params or {},
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(object):
+    """Two tier cache: in-memory LRU in front of a SQLite file.
+
+    - max_memory_entries : size of the LRU tier
+    - max_disk_entries : size of the SQLite tier (oldest entries are evicted)
+    - ttl : seconds an entry stays valid, None keeps it forever
+    """
+
+    def __init__(
+        self,
+        path="./results/cache/responses.sqlite3",
+        max_memory_entries=1024,
+        max_disk_entries=100000,
+        ttl=None,
+    ) -> None:
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self._writes = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_created_at ON responses(created_at)"
+            )
+            self.db.commit()
+
+    @property
+    def hits(self):
+        return self.stats["memory_hits"] + self.stats["disk_hits"]
+
+    @property
+    def misses(self):
+        return self.stats["misses"]
+
+    def _expired(self, created_at):
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def _remember(self, key, content, created_at):
+        self.memory[key] = (content, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1]):
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry[0]
+                del self.memory[key]
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT content, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    self._remember(key, row[0], row[1])
+                    self.stats["disk_hits"] += 1
+                    return row[0]
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key, content):
+        now = time.time()
+        with self._lock:
+            self._remember(key, content, now)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses (key, content, created_at) VALUES (?, ?, ?)",
+                    (key, content, now),
+                )
+                self._writes += 1
+                # the eviction scan is not free, amortize it over several writes
+                if self._writes % 100 == 0:
+                    self._evict_disk(now)
+                self.db.commit()
+
+    def _evict_disk(self, now):
+        if self.ttl is not None:
+            cur = self.db.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+            )
+            self.stats["evictions"] += max(cur.rowcount, 0)
+        if self.max_disk_entries is not None:
+            cur = self.db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,),
+            )
+            self.stats["evictions"] += max(cur.rowcount, 0)
+
+    def clear(self):
+        with self._lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM responses")
+                self.db.commit()
+
+    def close(self):
+        with self._lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
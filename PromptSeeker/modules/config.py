@@ -1,23 +1,44 @@
-from dotenv import load_dotenv
+## Settings of PromptSeeker
+# the secrets come from the environment (.env), read by load() when one is first used
+import os
 
-load_dotenv()
+ENV_SETTINGS = (
+    "DB_TYPE",
+    "DB_ENDPOINT",
+    "DB_TOKEN",
+    "ORGANIZATION_ID",
+    "COMMON_TOKEN",
+    "WORLD_TOKEN",
+    "SPECIES_TOKEN",
+    "CHARACTER_TOKEN",
+    "NOVERIST_TOKEN",
+    "OBSERVER_TOKEN",
+)
+
+_loaded = False
+
+
+def load(dotenv_path=None, override=False):
+    """Read the .env file (or `dotenv_path`) and set the ENV_SETTINGS of this module.
+
+    Runs by itself on the first access to one of them; call it first to read
+    another file.
+    """
+    global _loaded
+    from dotenv import load_dotenv
+
+    load_dotenv(dotenv_path, override=override)
+    for name in ENV_SETTINGS:
+        globals()[name] = os.getenv(name)
+    _loaded = True
+
+
+def __getattr__(name):
+    if name in ENV_SETTINGS and not _loaded:
+        load()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-import os
-import sys
-
-sys.path.append(os.path.dirname(os.getcwd()))
-
-# laod dotenv file
-DB_TYPE = os.getenv("DB_TYPE")
-DB_ENDPOINT = os.getenv("DB_ENDPOINT")
-DB_TOKEN = os.getenv("DB_TOKEN")
-ORGANIZATION_ID = os.getenv("ORGANIZATION_ID")
-COMMON_TOKEN = os.getenv("COMMON_TOKEN")
-WORLD_TOKEN = os.getenv("WORLD_TOKEN")
-SPECIES_TOKEN = os.getenv("SPECIES_TOKEN")
-CHARACTER_TOKEN = os.getenv("CHARACTER_TOKEN")
-NOVERIST_TOKEN = os.getenv("NOVERIST_TOKEN")
-OBSERVER_TOKEN = os.getenv("OBSERVER_TOKEN")
 
 MODERATE_CATEGORY_SCORE = {
     "hate": 0.5,
@@ -28,3 +49,39 @@ MODERATE_CATEGORY_SCORE = {
     "violence": 0.5,
     "violence/graphic": 0.5,
 }
+
+# requests / tokens per minute of each engine, shared by every OpenAIWrapper
+RATE_LIMITS = {
+    "default": {"rpm": 60, "tpm": 40000},
+    "gpt-3.5-turbo": {"rpm": 3500, "tpm": 90000},
+    "gpt-4": {"rpm": 200, "tpm": 40000},
+    "davinci": {"rpm": 3000, "tpm": 250000},
+}
+
+# context window (prompt + completion tokens) of each engine
+CONTEXT_WINDOWS = {
+    "default": 4096,
+    "gpt-3.5-turbo": 4096,
+    "gpt-4": 8192,
+    "davinci": 2049,
+}
+
+# tokens per stage: prompts over max_input_tokens are compacted,
+# max_tokens caps the completion sent to the API; both together must fit
+# CONTEXT_WINDOWS, max_tokens is cut to what the compacted prompt leaves
+STAGE_TOKEN_BUDGETS = {
+    "decompose_goal": {"max_input_tokens": 2500, "max_tokens": 1200},
+    "optimize_variables": {"max_input_tokens": 2000, "max_tokens": 800},
+    "redefine_goal_and_variables": {"max_input_tokens": 2000, "max_tokens": 800},
+    "generate_step_prompts": {"max_input_tokens": 2000, "max_tokens": 600},
+    # every step prompt in one answer (PromptSeek(batch_steps=True))
+    "generate_step_prompts_batched": {"max_input_tokens": 1200, "max_tokens": 2800},
+}
+
+# seconds a stage may take with its retries, None for no deadline
+STAGE_DEADLINES = {
+    "decompose_goal": 180.0,
+    "optimize_variables": 120.0,
+    "redefine_goal_and_variables": 120.0,
+    "generate_step_prompts": 300.0,
+}
@@ -0,0 +1,57 @@
+## Convergence detectors for PromptSeek.auto_seek
+import re
+
+# "- [P3]:", "P3 :", "[P3] =" ... at the head of a step
+_STEP_LABEL = re.compile(r"^\W*P(?:\d+|END)\]?\s*[:=]?\s*")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_step(step):
+    """Lower case text of a step without its P# label, bullets and extra spaces"""
+    step = _STEP_LABEL.sub("", str(step).strip())
+    return _SPACES.sub(" ", step).strip(" -*:").lower()
+
+
+class ExactConvergence(object):
+    """Converged when two decompositions are exactly the same"""
+
+    def similarity(self, previous, current):
+        return 1.0 if list(previous) == list(current) else 0.0
+
+    def __call__(self, previous, current):
+        return self.similarity(previous, current) >= 1.0
+
+
+class NormalizedTextConvergence(ExactConvergence):
+    """Converged when two decompositions are equal after normalize_step"""
+
+    def similarity(self, previous, current):
+        previous = [normalize_step(s) for s in previous]
+        current = [normalize_step(s) for s in current]
+        return 1.0 if previous == current else 0.0
+
+
+class EmbeddingConvergence(ExactConvergence):
+    """Converged when the embeddings of two decompositions are close enough.
+
+    - threshold : cosine similarity of the whole decompositions to be converged
+    - embed : function(texts) -> normalized vectors, defaults to sentence-transformers
+    """
+
+    def __init__(self, threshold=0.98, embed=None) -> None:
+        self.threshold = threshold
+        self.embed = embed
+
+    def similarity(self, previous, current):
+        previous = "\n".join(normalize_step(s) for s in previous)
+        current = "\n".join(normalize_step(s) for s in current)
+        if previous == current:
+            return 1.0
+        # numpy / sentence-transformers are only needed here
+        from PromptSeeker.modules.embeddings import cosine_similarity_matrix, embed_texts
+
+        vectors = (self.embed or embed_texts)([previous, current])
+        return float(cosine_similarity_matrix(vectors[:1], vectors[1:])[0, 0])
+
+    def __call__(self, previous, current):
+        return self.similarity(previous, current) >= self.threshold
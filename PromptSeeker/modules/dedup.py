@@ -0,0 +1,75 @@
+## Duplicate steps of a decomposition, collapsed before step generation
+import re
+
+from PromptSeeker.modules.convergence import normalize_step
+
+# a step that only points at another one, e.g. "- [P0]" or "P2:"
+_STEP_REFERENCE = re.compile(r"^\W*P(\d+)\]?\W*$")
+
+
+def step_reference(step):
+    """Index of the step `step` refers to, None when it has contents of its own"""
+    match = _STEP_REFERENCE.match(str(step).strip())
+    return int(match.group(1)) if match else None
+
+
+class StepDeduplicator(object):
+    """Group the steps of a decomposition saying the same thing.
+
+    Calling it with the steps returns, for every position, the position of the
+    first step of its group (groups[i] == i for the steps to generate).
+
+    - exact duplicates after normalize_step, steps normalized to nothing stay alone
+    - reference steps ("[P0]") pointing at an earlier step
+    - threshold : cosine similarity over which two steps are near duplicates,
+        None (default) skips the embedding pass: near duplicates are opt-in since
+        they need sentence-transformers
+    - embed : function(texts) -> vectors, defaults to sentence-transformers
+    """
+
+    def __init__(self, threshold=None, embed=None) -> None:
+        self.threshold = threshold
+        self.embed = embed
+
+    def __call__(self, steps):
+        groups = list(range(len(steps)))
+        first_of = {}
+        texts = []
+        for i, step in enumerate(steps):
+            reference = step_reference(step)
+            if reference is not None and reference < i:
+                groups[i] = groups[reference]
+                continue
+            text = normalize_step(step)
+            if not text:
+                # nothing left to compare (e.g. a lone character), never a duplicate
+                continue
+            if reference is None and text in first_of:
+                groups[i] = first_of[text]
+                continue
+            first_of.setdefault(text, i)
+            texts.append((i, text))
+
+        if self.threshold is not None and len(texts) > 1:
+            self._group_similar(groups, texts)
+        return groups
+
+    def _group_similar(self, groups, texts):
+        # numpy / sentence-transformers are only needed here
+        import numpy as np
+
+        from PromptSeeker.modules.embeddings import cosine_similarity_matrix, embed_texts
+
+        positions = [i for i, _ in texts]
+        vectors = (self.embed or embed_texts)([text for _, text in texts])
+        # similar[a, b] : step b is an earlier near duplicate of step a
+        similar = np.tril(cosine_similarity_matrix(vectors) >= self.threshold, k=-1)
+        leaders = np.ones(len(positions), dtype=bool)
+        for a in np.flatnonzero(similar.any(axis=1)):
+            earlier = np.flatnonzero(similar[a] & leaders)
+            if earlier.size:
+                leaders[a] = False
+                groups[positions[a]] = positions[earlier[0]]
+        # reference steps follow the group of the step they point at
+        for i, group in enumerate(groups):
+            groups[i] = groups[group]
@@ -0,0 +1,40 @@
+## Sentence embeddings (sentence-transformers), loaded lazily
+import threading
+
+import numpy as np
+
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+
+
+def get_model(model_name=DEFAULT_MODEL_NAME):
+    """SentenceTransformer shared by the process, loaded on first use"""
+    with _MODELS_LOCK:
+        model = _MODELS.get(model_name)
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(model_name)
+            _MODELS[model_name] = model
+        return model
+
+
+def embed_texts(texts, model_name=DEFAULT_MODEL_NAME):
+    """L2 normalized embeddings of `texts` as a (len(texts), dim) float32 array"""
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    vectors = get_model(model_name).encode(
+        list(texts), convert_to_numpy=True, normalize_embeddings=True
+    )
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def cosine_similarity_matrix(a, b=None):
+    """Cosine similarity of every row of `a` against every row of `b`"""
+    a = np.asarray(a, dtype=np.float32)
+    b = a if b is None else np.asarray(b, dtype=np.float32)
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return a @ b.T
@@ -0,0 +1,244 @@
+## Deterministic in-process stand-in of the openai module, for benchmarks
+"""
+open_ai_wapper = OpenAIWrapper(backend=FakeOpenAI(latency="lognormal:0.8,0.4", error_rate=0.02))
+
+Answers are canned responses taken from saved runs (retults/prompt_seeks/ by
+default), chosen from the request content so a run is reproducible for a seed.
+"""
+import glob
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+
+import openai
+from openai.openai_object import OpenAIObject
+
+from PromptSeeker.modules.tokens import count_message_tokens, count_tokens
+
+DEFAULT_CORPUS_DIRS = ("./retults/prompt_seeks/",)
+
+# stage of a request, recognized from its system rule
+_STAGE_KEYWORDS = (
+    ("decompose", "decomposition"),
+    ("optimize", "optimization"),
+    ("redefine", "redefinition"),
+    ("step prompts", "step_prompt"),
+)
+
+# batched step generation, answered with a dict of canned step prompts
+_BATCHED_STEPS = re.compile(r'python dict whose keys are ((?:"O\d+"(?:, )?)+)')
+
+
+class LatencyModel(object):
+    """Latency distribution given as "kind:params"
+
+    - "zero"
+    - "constant:seconds"
+    - "uniform:low,high"
+    - "lognormal:median,sigma"
+    """
+
+    def __init__(self, spec="zero", scale=1.0) -> None:
+        self.spec = spec
+        self.scale = scale
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p]
+        if kind not in ("zero", "constant", "uniform", "lognormal"):
+            raise ValueError(f"unknown latency distribution {spec!r}")
+
+    def sample(self, rng):
+        if self.kind == "zero":
+            seconds = 0.0
+        elif self.kind == "constant":
+            seconds = self.params[0]
+        elif self.kind == "uniform":
+            seconds = rng.uniform(self.params[0], self.params[1])
+        else:
+            seconds = rng.lognormvariate(math.log(self.params[0]), self.params[1])
+        return seconds * self.scale
+
+
+def load_corpus(corpus_dirs=DEFAULT_CORPUS_DIRS):
+    """Canned responses of every stage found in saved PromptSeek JSONs"""
+    corpus = {"decomposition": [], "optimization": [], "redefinition": [], "step_prompt": []}
+    for corpus_dir in corpus_dirs:
+        for path in sorted(glob.glob(os.path.join(corpus_dir, "*.json"))):
+            with open(path, encoding="utf-8") as f:
+                record = json.load(f)
+            for field, stage in (
+                ("plane_decomposed_steps", "decomposition"),
+                ("plane_optimization", "optimization"),
+                ("plane_redefinition", "redefinition"),
+            ):
+                if record.get(field):
+                    corpus[stage].append(record[field])
+            corpus["step_prompt"].extend(p for p in record.get("step_prompts", []) if p)
+    for stage, responses in corpus.items():
+        if not responses:
+            corpus[stage] = [f"[{stage}] canned response"]
+    return corpus
+
+
+class _Resource(object):
+    def __init__(self, backend, kind) -> None:
+        self.backend = backend
+        self.kind = kind
+
+    def create(self, **kwargs):
+        return self.backend._create(self.kind, **kwargs)
+
+
+class FakeOpenAI(object):
+    """Stand-in of the openai module for OpenAIWrapper(backend=...).
+
+    - latency : LatencyModel or its spec, time to the first token
+    - token_latency : seconds per streamed chunk
+    - error_rate : probability of a transient error (429 / 503 / timeout) per request
+    - seed : seed of the latency / error draws
+
+    The request_timeout of a request is honoured: a slower answer raises
+    openai.error.Timeout once the timeout passed.
+    """
+
+    error = openai.error
+
+    def __init__(
+        self,
+        corpus_dirs=DEFAULT_CORPUS_DIRS,
+        latency="zero",
+        token_latency=0.0,
+        error_rate=0.0,
+        seed=0,
+        stream_chunk_size=16,
+    ) -> None:
+        self.corpus = load_corpus(corpus_dirs)
+        self.latency = latency if isinstance(latency, LatencyModel) else LatencyModel(latency)
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.stream_chunk_size = stream_chunk_size
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.organization = None
+        self.api_key = None
+        self.ChatCompletion = _Resource(self, "chat")
+        self.Completion = _Resource(self, "completion")
+        self.Moderation = _Resource(self, "moderation")
+
+    def _draw(self):
+        with self._lock:
+            self.requests += 1
+            latency = self.latency.sample(self.rng)
+            failure = self.rng.random() < self.error_rate
+            kind = self.rng.random()
+            if failure:
+                self.errors += 1
+        return latency, failure, kind
+
+    def _raise(self, kind):
+        if kind < 0.5:
+            raise openai.error.RateLimitError(
+                "fake rate limit", headers={"retry-after": "0.01"}
+            )
+        if kind < 0.8:
+            raise openai.error.ServiceUnavailableError("fake overload", http_status=503)
+        raise openai.error.Timeout("fake timeout")
+
+    def respond(self, prompt):
+        """Canned response of a request, the same for the same request"""
+        if isinstance(prompt, str):
+            rule, text = "", prompt
+        else:
+            rule = prompt[0].get("content", "") if prompt else ""
+            text = json.dumps(prompt, sort_keys=True, ensure_ascii=False)
+        stage = "step_prompt"
+        for keyword, name in _STAGE_KEYWORDS:
+            if keyword in rule:
+                stage = name
+                break
+        responses = self.corpus[stage]
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        batched = None
+        if not isinstance(prompt, str) and prompt:
+            batched = _BATCHED_STEPS.search(prompt[-1].get("content", ""))
+        if batched:
+            start = int.from_bytes(digest[:4], "big")
+            return json.dumps(
+                {
+                    key: responses[(start + i) % len(responses)]
+                    for i, key in enumerate(re.findall(r"O\d+", batched.group(1)))
+                },
+                ensure_ascii=False,
+                indent=1,
+            )
+        return responses[int.from_bytes(digest[:4], "big") % len(responses)]
+
+    def _create(self, kind, **kwargs):
+        latency, failure, error_kind = self._draw()
+        timeout = kwargs.get("request_timeout")
+        if timeout is not None and latency > timeout:
+            # the client gives up waiting, as requests does
+            time.sleep(timeout)
+            raise openai.error.Timeout(f"fake request timed out after {timeout:.2f}s")
+
+        if kind == "moderation":
+            time.sleep(latency)
+            if failure:
+                self._raise(error_kind)
+            inputs = kwargs["input"]
+            inputs = inputs if isinstance(inputs, list) else [inputs]
+            return OpenAIObject.construct_from(
+                {
+                    "results": [
+                        {"flagged": False, "category_scores": {}, "categories": {}}
+                        for _ in inputs
+                    ]
+                }
+            )
+
+        prompt = kwargs.get("messages", kwargs.get("prompt", ""))
+        content = self.respond(prompt)
+        max_tokens = kwargs.get("max_tokens")
+        if max_tokens is not None and count_tokens(content) > max_tokens:
+            content = content[: max_tokens * 4]
+        if kwargs.get("stream"):
+            return self._stream(kind, content, latency, failure, error_kind)
+
+        time.sleep(latency)
+        if failure:
+            self._raise(error_kind)
+        usage = {
+            "prompt_tokens": count_message_tokens(prompt),
+            "completion_tokens": count_tokens(content),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if kind == "chat":
+            choice = {"index": 0, "message": {"role": "assistant", "content": content}}
+        else:
+            choice = {"index": 0, "text": content, "message": {"content": ""}}
+        return OpenAIObject.construct_from({"choices": [choice], "usage": usage})
+
+    def _stream(self, kind, content, latency, failure, error_kind):
+        time.sleep(latency)
+        if failure:
+            self._raise(error_kind)
+
+        def chunks():
+            for i in range(0, len(content), self.stream_chunk_size):
+                if i and self.token_latency:
+                    time.sleep(self.token_latency)
+                piece = content[i : i + self.stream_chunk_size]
+                if kind == "chat":
+                    choice = {"index": 0, "delta": {"content": piece}}
+                else:
+                    choice = {"index": 0, "text": piece}
+                yield OpenAIObject.construct_from({"choices": [choice]})
+
+        return chunks()
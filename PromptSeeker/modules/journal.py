@@ -0,0 +1,36 @@
+## Append-only JSONL journal of a PromptSeek run
+import json
+import os
+import threading
+import time
+
+
+class RunJournal(object):
+    """Append-only JSONL file, one record per completed stage or run event"""
+
+    def __init__(self, path) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        record = dict(record, time=time.time())
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self):
+        """Records written so far, a torn last line (crash while writing) is skipped"""
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+        return records
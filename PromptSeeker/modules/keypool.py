@@ -0,0 +1,182 @@
+## Several API keys behind one OpenAIWrapper, each with its own quota and health
+import threading
+import time
+
+import openai
+
+import PromptSeeker.modules.config as CONFIG
+from PromptSeeker.modules.ratelimit import new_limiter
+
+# keys of config.py shared by the pool, in order of preference
+TOKEN_NAMES = (
+    "COMMON_TOKEN",
+    "WORLD_TOKEN",
+    "SPECIES_TOKEN",
+    "CHARACTER_TOKEN",
+    "NOVERIST_TOKEN",
+    "OBSERVER_TOKEN",
+)
+
+# errors telling the key itself is unusable
+KEY_ERRORS = (openai.error.AuthenticationError, openai.error.PermissionError)
+
+
+class NoHealthyKeyError(RuntimeError):
+    """Every key of the pool was disabled"""
+
+
+class ApiKey(object):
+    """One credential with its own rate limiter and health state.
+
+    - rate_limiter : RateLimiter of this key's quota, defaults to CONFIG.RATE_LIMITS
+    - A key failing `max_failures` times in a row cools down for `cooldown` seconds,
+      a key rejected by the API (401 / 403) is disabled.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        organization=None,
+        name=None,
+        engine="gpt-3.5-turbo",
+        rate_limiter=None,
+        max_failures=3,
+        cooldown=30.0,
+    ) -> None:
+        self.api_key = api_key
+        self.organization = organization
+        self.name = name or "key"
+        self.rate_limiter = rate_limiter or new_limiter(engine)
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.failures = 0
+        self.unhealthy_until = 0.0
+        self.disabled = False
+
+    @property
+    def credentials(self):
+        """Keyword arguments of openai create() calls"""
+        return {"api_key": self.api_key, "organization": self.organization}
+
+    def is_available(self, now):
+        return not self.disabled and self.unhealthy_until <= now
+
+    def __repr__(self):
+        return f"ApiKey({self.name})"
+
+
+class KeyPool(object):
+    """Spread requests over several keys, the least loaded healthy key first.
+
+    OpenAIWrapper(key_pool=KeyPool.from_config()) then scales with the number
+    of keys instead of one quota.
+    """
+
+    def __init__(self, keys) -> None:
+        if not keys:
+            raise ValueError("KeyPool needs at least one key")
+        self.keys = list(keys)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, engine="gpt-3.5-turbo", names=TOKEN_NAMES, **key_kwargs):
+        """Pool of the distinct tokens of config.py that are set"""
+        keys = []
+        seen = set()
+        for name in names:
+            token = getattr(CONFIG, name, None)
+            if not token or token in seen:
+                continue
+            seen.add(token)
+            keys.append(
+                ApiKey(
+                    token,
+                    organization=CONFIG.ORGANIZATION_ID,
+                    name=name,
+                    engine=engine,
+                    **key_kwargs,
+                )
+            )
+        return cls(keys)
+
+    def _pick(self, tokens, now):
+        enabled = [k for k in self.keys if not k.disabled]
+        if not enabled:
+            raise NoHealthyKeyError("every API key of the pool was disabled")
+        available = [k for k in enabled if k.is_available(now)]
+        if not available:
+            # everything cools down: take the key back first
+            return min(enabled, key=lambda k: k.unhealthy_until)
+        return min(
+            available, key=lambda k: (k.rate_limiter.wait_time(tokens), k.in_flight)
+        )
+
+    def pick(self, tokens=0):
+        """Key a request of `tokens` tokens would use, without reserving it"""
+        with self._lock:
+            return self._pick(tokens, time.monotonic())
+
+    def acquire(self, tokens=0, timeout=None):
+        """Reserve a request of `tokens` tokens on the best key, blocking for its quota.
+
+        Returns None when the key would not be ready within `timeout` seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            key = self._pick(tokens, now)
+            key.in_flight += 1
+            wait = key.unhealthy_until - now
+        if timeout is not None and wait > timeout:
+            self._cancel(key)
+            return None
+        if wait > 0:
+            time.sleep(wait)
+            if timeout is not None:
+                timeout -= wait
+        if not key.rate_limiter.acquire(tokens, timeout=timeout):
+            self._cancel(key)
+            return None
+        return key
+
+    def _cancel(self, key):
+        # the reservation was not used, nothing to report on the key
+        with self._lock:
+            key.in_flight -= 1
+
+    def release(self, key, error=None):
+        """Report the outcome of a request sent with `key`"""
+        with self._lock:
+            key.in_flight -= 1
+            if error is None:
+                key.failures = 0
+                key.unhealthy_until = 0.0
+                return
+            if isinstance(error, KEY_ERRORS):
+                key.disabled = True
+                print(f"{key.name} disabled: {error!r}")
+                return
+            key.failures += 1
+            if key.failures >= key.max_failures:
+                key.failures = 0
+                key.unhealthy_until = time.monotonic() + key.cooldown
+                print(f"{key.name} cools down for {key.cooldown:.0f}s")
+
+    def has_available_key(self):
+        with self._lock:
+            return any(not k.disabled for k in self.keys)
+
+    def status(self):
+        """Health of every key, e.g. for a status page"""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "name": k.name,
+                    "in_flight": k.in_flight,
+                    "disabled": k.disabled,
+                    "cooling_down": max(0.0, k.unhealthy_until - now),
+                    "rate_scale": k.rate_limiter.scale,
+                }
+                for k in self.keys
+            ]
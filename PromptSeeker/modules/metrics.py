@@ -0,0 +1,167 @@
+## Counters, span timers and their export (Prometheus text / JSON)
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Metrics of the PromptSeek run executing in the current context
+_RUN_METRICS = contextvars.ContextVar("promptseek_run_metrics", default=None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metrics(object):
+    """Thread safe counters and timers.
+
+    Everything recorded is also recorded on `parent`, so a per-run registry
+    feeds the process wide METRICS. Hooks are called as
+    hook(name, labels, seconds, error) at the end of every span.
+    """
+
+    def __init__(self, parent=None, buckets=DEFAULT_BUCKETS) -> None:
+        self.parent = parent
+        self.buckets = buckets
+        self.counters = {}
+        self.timers = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        if self.parent is not None:
+            self.parent.inc(name, value, **labels)
+
+    def observe(self, name, seconds, error=None, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = {
+                    "count": 0,
+                    "sum": 0.0,
+                    "max": 0.0,
+                    "buckets": [0] * len(self.buckets),
+                }
+            timer["count"] += 1
+            timer["sum"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    timer["buckets"][i] += 1
+        for hook in list(self.hooks):
+            hook(name, labels, seconds, error)
+        if self.parent is not None:
+            self.parent.observe(name, seconds, error=error, **labels)
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        """Time the block into the `name` timer"""
+        started_at = time.perf_counter()
+        error = None
+        try:
+            yield labels
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started_at, error=error, **labels)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make this registry the one `current()` returns inside the block"""
+        token = _RUN_METRICS.set(self)
+        try:
+            yield self
+        finally:
+            _RUN_METRICS.reset(token)
+
+    def summary(self):
+        """JSON friendly snapshot: {"counters": {...}, "timers": {...}}"""
+        with self._lock:
+            counters = {
+                name + _format_labels(labels): value
+                for (name, labels), value in sorted(self.counters.items())
+            }
+            timers = {
+                name + _format_labels(labels): {
+                    "count": t["count"],
+                    "sum": round(t["sum"], 6),
+                    "mean": round(t["sum"] / t["count"], 6),
+                    "max": round(t["max"], 6),
+                }
+                for (name, labels), t in sorted(self.timers.items())
+            }
+        return {"counters": counters, "timers": timers}
+
+    def to_prometheus(self):
+        """Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), t in timers:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for bound, count in zip(self.buckets, t["buckets"]):
+                lines.append(
+                    f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}"
+                )
+            lines.append(
+                f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {t['count']}"
+            )
+            lines.append(f"{name}_sum{_format_labels(labels)} {t['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {t['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the Prometheus text atomically (node_exporter textfile collector)"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+
+
+# process wide registry
+METRICS = Metrics()
+
+
+def current():
+    """Metrics of the running PromptSeek stage, else the process wide METRICS"""
+    return _RUN_METRICS.get() or METRICS
@@ -0,0 +1,115 @@
+## Batched moderation running off the critical path
+import contextvars
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import PromptSeeker.modules.config as CONFIG
+
+
+class ModerationError(ValueError):
+    """A response scored over MODERATE_CATEGORY_SCORE"""
+
+
+def moderation_violations(category_scores, thresholds=None):
+    """Categories of `category_scores` over their threshold"""
+    thresholds = CONFIG.MODERATE_CATEGORY_SCORE if thresholds is None else thresholds
+    return [k for k, v in category_scores.items() if v > thresholds.get(k, 1)]
+
+
+def raise_for_violations(violations):
+    if violations:
+        raise ModerationError("Moderation failed at {}".format(violations[0]))
+
+
+def _content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ModerationBatcher(object):
+    """Moderate many texts with one Moderation request per batch, in the background.
+
+    submit() returns one Future per text, resolved with its violated categories
+    ([] when it passes). Verdicts are cached by content hash.
+    - moderate : function(list of texts) -> moderation response (OpenAIWrapper.moderate)
+    """
+
+    def __init__(self, moderate, max_batch=32, max_workers=2, cache_size=4096) -> None:
+        self.moderate = moderate
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.verdicts = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="moderation"
+        )
+
+    def _cached(self, key):
+        with self._lock:
+            verdict = self.verdicts.get(key)
+            if verdict is not None:
+                self.verdicts.move_to_end(key)
+            return verdict
+
+    def _remember(self, key, verdict):
+        with self._lock:
+            self.verdicts[key] = verdict
+            self.verdicts.move_to_end(key)
+            while len(self.verdicts) > self.cache_size:
+                self.verdicts.popitem(last=False)
+
+    def submit(self, texts):
+        """Futures of the verdicts of `texts`, in the same order"""
+        futures = []
+        pending = OrderedDict()
+        for text in texts:
+            key = _content_hash(text)
+            verdict = self._cached(key)
+            if verdict is not None:
+                future = Future()
+                future.set_result(verdict)
+            elif key in pending:
+                future = pending[key][1]
+            else:
+                future = Future()
+                pending[key] = (text, future)
+            futures.append(future)
+
+        items = list(pending.items())
+        for start in range(0, len(items), self.max_batch):
+            batch = items[start : start + self.max_batch]
+            context = contextvars.copy_context()
+            self._executor.submit(context.run, self._run_batch, batch)
+        return futures
+
+    def _run_batch(self, batch):
+        try:
+            response = self.moderate([text for _, (text, _) in batch])
+            results = response["results"]
+            for (key, (_, future)), result in zip(batch, results):
+                verdict = moderation_violations(result["category_scores"])
+                self._remember(key, verdict)
+                future.set_result(verdict)
+            if len(results) < len(batch):
+                raise ValueError(
+                    f"moderation answered {len(results)} of {len(batch)} texts"
+                )
+        except Exception as e:
+            # every future resolves, wait() never blocks on a lost verdict
+            for _, (_, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def check(self, texts):
+        """Block until every verdict of `texts` is known, raise ModerationError on a violation"""
+        wait(self.submit(texts))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def wait(futures):
+    """Block on verdict futures, raise ModerationError on the first violation"""
+    for future in futures:
+        raise_for_violations(future.result())
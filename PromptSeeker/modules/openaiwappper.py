@@ -1,22 +1,115 @@
 ## Use Open API
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+
 import openai
-import time 
 
 import PromptSeeker.modules.config as CONFIG
-
-ORGANIZATION_ID = CONFIG.ORGANIZATION_ID
-API_KEY = CONFIG.COMMON_TOKEN
-MODERATE_CATEGORY_SCORE = CONFIG.MODERATE_CATEGORY_SCORE
+from PromptSeeker.modules.cache import CacheMissError, make_key
+from PromptSeeker.modules.keypool import KEY_ERRORS
+from PromptSeeker.modules.metrics import current as current_metrics
+from PromptSeeker.modules.moderation import (
+    ModerationBatcher,
+    moderation_violations,
+    raise_for_violations,
+)
+from PromptSeeker.modules.ratelimit import RetryPolicy, estimate_tokens, get_limiter
+from PromptSeeker.modules.resilience import (
+    CircuitBreaker,
+    DeadlineExceeded,
+    LatencyTracker,
+    remaining,
+)
+from PromptSeeker.modules.transport import install_session
 
 
 class OpenAIWrapper(object):
-    def __init__(self, api_key=API_KEY, organization_id = ORGANIZATION_ID,engine="gpt-3.5-turbo", max_retry=3) -> None:
+    def __init__(
+        self,
+        api_key=None,
+        organization_id=None,
+        engine="gpt-3.5-turbo",
+        max_retry=3,
+        cache=None,
+        cache_only=False,
+        rate_limiter=None,
+        retry_policy=None,
+        verbose=True,
+        backend=None,
+        key_pool=None,
+        request_timeout=120.0,
+        hedge_percentile=None,
+        hedge_min_samples=20,
+        hedge_workers=16,
+        circuit_breaker=None,
+    ) -> None:
+        """
+        - api_key / organization_id : default to CONFIG.COMMON_TOKEN / CONFIG.ORGANIZATION_ID
+        - cache : ResponseCache put in front of ask
+        - cache_only : replay mode, answer only from the cache and never call the API
+        - rate_limiter : RateLimiter, defaults to the one shared by every wrapper of `engine`
+        - max_retry : retries of a transient error when no retry_policy is given
+        - retry_policy : RetryPolicy deciding which errors are retried, how often and
+            how long to wait; its max_retry replaces `max_retry`
+        - verbose : print every response
+        - backend : object standing for the openai module (e.g. fakellm.FakeOpenAI)
+        - key_pool : KeyPool spreading the calls over several keys, replaces
+            api_key / organization_id and rate_limiter
+        - request_timeout : seconds one call may take, shortened to what is left of the
+            current deadline (see resilience.deadline), None for no timeout
+        - hedge_percentile : e.g. 0.95, a call still running after this latency
+            percentile of its kind gets a duplicate and the first answer wins;
+            None disables hedging
+        - hedge_min_samples : latencies observed before a kind of call is hedged
+        - hedge_workers : threads running the hedged calls
+        - circuit_breaker : CircuitBreaker failing the calls fast while the backend
+            keeps erroring, defaults to CircuitBreaker(), False disables it
+
+        The credentials are sent with every call so wrappers of different keys
+        can share a process; the HTTP connection pool is one for the whole
+        process (see transport.install_session).
+        """
         super().__init__()
-        self.openai = openai
-        self.openai.organization = organization_id
-        self.openai.api_key = api_key
+        self.openai = backend or openai
+        if backend is None:
+            install_session(openai)
+        if key_pool is None:
+            # read from the environment only when the key is actually needed
+            if api_key is None:
+                api_key = CONFIG.COMMON_TOKEN
+            if organization_id is None:
+                organization_id = CONFIG.ORGANIZATION_ID
+        self.api_key = api_key
+        self.organization = organization_id
+        self.key_pool = key_pool
         self.engine = engine
-        self.max_retry = max_retry
+        self.rate_limiter = rate_limiter or get_limiter(engine)
+        self.retry_policy = retry_policy or RetryPolicy(max_retry=max_retry)
+        self.max_retry = self.retry_policy.max_retry
+        self.cache = cache
+        self.cache_only = cache_only
+        self.verbose = verbose
+        # API calls sent by this wrapper, shared by every thread using it
+        self.call_count = 0
+        self._count_lock = threading.Lock()
+        self._moderation_batcher = None
+        self.request_timeout = request_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_workers = hedge_workers
+        self.latency = LatencyTracker()
+        self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker = circuit_breaker or None
+        if cache_only and cache is None:
+            raise ValueError("cache_only requires a cache")
 
     def _davinchi(
         self,
@@ -27,9 +120,12 @@ class OpenAIWrapper(object):
         frequency_penalty=0,
         presence_penalty=0,
         stop=["\n", " Human:", " AI:"],
+        stream=False,
+        **credentials,
     ):
         return self.openai.Completion.create(
             engine="davinci",
+            stream=stream,
             prompt=prompt,
             max_tokens=max_tokens,
             temperature=temperature,
@@ -37,64 +133,446 @@ class OpenAIWrapper(object):
             frequency_penalty=frequency_penalty,
             presence_penalty=presence_penalty,
             stop=stop,
+            **credentials,
         )
 
     def _ChatGpt(
         self,
         prompt,
-        max_tokens=100,
+        max_tokens=None,
         temperature=0.5,
         top_p=1,
         frequency_penalty=0,
         presence_penalty=0,
-        stop=["\n", " Human:", " AI:"],
+        stop=None,
+        stream=False,
+        **credentials,
     ):
         """GPT general call function"""
         # print(prompt)
-        time.sleep(1)
+        params = {
+            "temperature": temperature,
+            "top_p": top_p,
+            "frequency_penalty": frequency_penalty,
+            "presence_penalty": presence_penalty,
+        }
+        # unset caps are left to the API defaults (no stop, the rest of the context)
+        if max_tokens is not None:
+            params["max_tokens"] = max_tokens
+        if stop is not None:
+            params["stop"] = stop
         return self.openai.ChatCompletion.create(
             model=self.engine,
+            stream=stream,
             messages=prompt,  # this may need to contain a list of messages
+            **params,
+            **credentials,
+        )
+
+    def _moderation_create(self, texts, **credentials):
+        """Moderation.create with all the credentials, the one of openai 0.27 only takes api_key"""
+        if self.openai is not openai:
+            return self.openai.Moderation.create(input=texts, **credentials)
+        request_timeout = credentials.pop("request_timeout", None)
+        instance = openai.Moderation(**credentials)
+        return instance.request(
+            "post",
+            openai.Moderation.get_url(),
+            {"input": texts},
+            request_timeout=request_timeout,
         )
 
     def moderate(self, res_text):
-        """Moderate the prompt"""
-        return self.openai.Moderation.create(input=res_text)
+        """Moderate the prompt, under the same limiter, retries, deadline and breaker as ask"""
+        metrics = current_metrics()
+        metrics.inc("promptseek_moderation_calls_total")
+        with metrics.span("promptseek_moderation_seconds"):
+            res, _ = self._create(
+                0,
+                request=functools.partial(self._moderation_create, res_text),
+                kind="moderation",
+            )
+        return res
+
+    def _check_moderation(self, content):
+        moderate_score = self.moderate(content)
+        c_score = moderate_score["results"][0]["category_scores"]
+        raise_for_violations(moderation_violations(c_score))
+
+    @property
+    def moderation_batcher(self):
+        """ModerationBatcher moderating in the background, created on first use"""
+        with self._count_lock:
+            if self._moderation_batcher is None:
+                self._moderation_batcher = ModerationBatcher(self.moderate)
+            return self._moderation_batcher
+
+    def _cache_lookup(self, kwargs, moderated=False):
+        """Return (cache_key, cached content or None)
+
+        Moderated calls have keys of their own: their entries are only written
+        once the content passed moderation, an unmoderated one never answers them.
+        """
+        if self.cache is None:
+            return None, None
+        params = {k: v for k, v in kwargs.items() if k != "prompt"}
+        if moderated:
+            params["use_common_moderation"] = True
+        cache_key = make_key(self.engine, kwargs.get("prompt", ""), params)
+        content = self.cache.get(cache_key)
+        if content is None:
+            current_metrics().inc("promptseek_cache_misses_total")
+        else:
+            current_metrics().inc("promptseek_cache_hits_total")
+        if content is None and self.cache_only:
+            raise CacheMissError(cache_key)
+        return cache_key, content
+
+    def _acquire(self, estimated):
+        """Wait for the quota of one call, returns (key or None, its limiter, credentials)
+
+        The wait is capped by the current deadline, DeadlineExceeded is raised
+        when the quota would only come after it.
+        """
+        timeout = remaining()
+        if timeout is not None and timeout <= 0:
+            raise DeadlineExceeded("deadline exceeded")
+        if self.key_pool is None:
+            if not self.rate_limiter.acquire(estimated, timeout=timeout):
+                raise DeadlineExceeded("no rate limit quota before the deadline")
+            credentials = {"api_key": self.api_key, "organization": self.organization}
+            return None, self.rate_limiter, credentials
+        key = self.key_pool.acquire(estimated, timeout=timeout)
+        if key is None:
+            raise DeadlineExceeded("no API key available before the deadline")
+        return key, key.rate_limiter, key.credentials
 
-    def ask(self, use_common_moderation=False, **kwargs):
+    def _timeout(self):
+        """Seconds the next call may take, raises DeadlineExceeded when none are left"""
+        left = remaining()
+        if left is None:
+            return self.request_timeout
+        if left <= 0:
+            raise DeadlineExceeded("deadline exceeded")
+        if self.request_timeout is None:
+            return left
+        return min(self.request_timeout, left)
+
+    def _send(self, estimated, stream, kwargs, request=None, kind=None):
+        """One call of the engine, returns (response, error, key, limiter) and never raises
+
+        - request : function(**credentials) sent instead of the engine call
+        - kind : kind of the call for the latencies, defaults to its max_tokens
+        """
+        metrics = current_metrics()
+        key, limiter = None, self.rate_limiter
+        try:
+            with metrics.span("promptseek_rate_limit_wait_seconds", engine=self.engine):
+                key, limiter, credentials = self._acquire(estimated)
+            timeout = self._timeout()
+            if timeout is not None:
+                credentials = dict(credentials, request_timeout=timeout)
+            with self._count_lock:
+                self.call_count += 1
+            metrics.inc("promptseek_llm_requests_total", engine=self.engine)
+            started_at = time.monotonic()
+            if request is not None:
+                res = request(**credentials)
+            elif self.engine == "davinci":
+                res = self._davinchi(stream=stream, **kwargs, **credentials)
+            elif "gpt" in self.engine:
+                res = self._ChatGpt(stream=stream, **kwargs, **credentials)
+            else:
+                raise ValueError("Engine not supported")
+        except Exception as e:
+            if key is not None:
+                self.key_pool.release(key, e)
+            return None, e, key, limiter
+        if not stream:
+            # calls of the same max_tokens take comparable times
+            if kind is None:
+                kind = kwargs.get("max_tokens")
+            self.latency.observe(kind, time.monotonic() - started_at)
+        if key is not None:
+            self.key_pool.release(key)
+        return res, None, key, limiter
+
+    def _hedge_pool(self):
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=self.hedge_workers, thread_name_prefix="promptseek-hedge"
+                )
+            return self._hedge_executor
+
+    def _send_hedged(self, estimated, kwargs, request=None, kind=None):
+        """_send, duplicated once the call runs past the hedge percentile of its kind"""
+        delay = None
+        if self.hedge_percentile is not None:
+            delay = self.latency.percentile(
+                kwargs.get("max_tokens") if kind is None else kind,
+                self.hedge_percentile,
+                self.hedge_min_samples,
+            )
+        send = functools.partial(
+            self._send, estimated, False, kwargs, request=request, kind=kind
+        )
+        if delay is None:
+            return send()
+
+        executor = self._hedge_pool()
+        futures = {executor.submit(contextvars.copy_context().run, send): "primary"}
+        try:
+            return next(iter(futures)).result(timeout=delay)
+        except FutureTimeout:
+            pass
+        metrics = current_metrics()
+        metrics.inc("promptseek_llm_hedges_total", engine=self.engine)
+        futures[executor.submit(contextvars.copy_context().run, send)] = "hedge"
+        pending = set(futures)
+        result = None
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                result = future.result()
+                if result[1] is None:
+                    # the other call cannot be aborted once sent, its answer is dropped
+                    for other in pending:
+                        other.cancel()
+                    metrics.inc(
+                        "promptseek_llm_hedge_wins_total",
+                        engine=self.engine,
+                        winner=futures[future],
+                    )
+                    return result
+        return result
+
+    def _create(self, estimated, stream=False, request=None, kind=None, **kwargs):
+        """Call the engine under the rate limiter, retrying transient errors.
+
+        Returns (response, limiter of the key that answered). Raises
+        DeadlineExceeded once the current deadline passed and CircuitOpenError
+        while the circuit breaker is open. `request` / `kind` : see _send.
+        """
+        metrics = current_metrics()
+        breaker = self.circuit_breaker
         retries = 0
-        while retries < self.max_retry:
-            try:
-                if self.engine == "davinci":
-                    res = self._davinchi(**kwargs)
-                elif "gpt" in self.engine:
-                    res = self._ChatGpt(**kwargs)
+        while True:
+            self._timeout()
+            if breaker is not None:
+                breaker.before_call()
+            if stream:
+                res, e, key, limiter = self._send(
+                    estimated, True, kwargs, request=request, kind=kind
+                )
+            else:
+                res, e, key, limiter = self._send_hedged(
+                    estimated, kwargs, request=request, kind=kind
+                )
+            if breaker is not None:
+                if isinstance(e, DeadlineExceeded):
+                    breaker.record(None)
                 else:
-                    raise ValueError("Engine not supported")
+                    # throttling and rejected requests mean the backend is up
+                    breaker.record(
+                        e is not None
+                        and self.retry_policy.is_transient(e)
+                        and not isinstance(e, openai.error.RateLimitError)
+                    )
+            if e is None:
+                return res, limiter
+            if isinstance(e, DeadlineExceeded):
+                raise e
+            retries += 1
+            # a rejected key is retried on the next key of the pool
+            retryable = self.retry_policy.is_transient(e) or (
+                key is not None
+                and isinstance(e, KEY_ERRORS)
+                and self.key_pool.has_available_key()
+            )
+            if retries >= self.max_retry or not retryable:
+                raise e  # すべてのリトライが失敗した場合、エラーを再度送出します
+            delay = self.retry_policy.delay(retries - 1, e)
+            if isinstance(e, openai.error.RateLimitError):
+                # pause the limiter as long as the capped Retry-After, if any
+                limiter.penalize(delay if self.retry_policy.retry_after(e) is not None else None)
+            if (
+                key is not None
+                and isinstance(e, (openai.error.RateLimitError,) + KEY_ERRORS)
+                and self.key_pool.pick(estimated) is not key
+            ):
+                # only this key is throttled or rejected, go on with the next one
+                delay = 0.0
+            left = remaining()
+            if left is not None and delay >= left:
+                # the retry could not finish in time
+                raise DeadlineExceeded(
+                    f"deadline exceeded after {retries} attempts: {e}"
+                ) from e
+            metrics.inc(
+                "promptseek_llm_retries_total",
+                engine=self.engine,
+                error=type(e).__name__,
+            )
+            print(
+                f"{type(e).__name__}: {e}. Retrying in {delay:.1f}s... ({retries}/{self.max_retry})"
+            )
+            time.sleep(delay)
 
-                if res.choices[0].message.content:
-                    content = res.choices[0].message.content
-                else:
-                    content = res.choices[0].text
+    def ask(self, use_common_moderation=False, stream=False, **kwargs):
+        """Ask the engine and return the content.
 
-                print(content)
-                if use_common_moderation:
-                    moderate_score = self.moderate(content)
-                    c_score = moderate_score["results"][0]["category_scores"]
-                    for k, v in c_score.items():
-                        if v > MODERATE_CATEGORY_SCORE.get(k, 1):
-                            raise ValueError("Moderation failed at {}".format(k))
+        With stream=True a StreamResponse is returned instead, which yields
+        the content deltas as they arrive.
+        """
+        if stream:
+            return StreamResponse(self, use_common_moderation, kwargs)
+
+        metrics = current_metrics()
+        with metrics.span(
+            "promptseek_llm_call_seconds", engine=self.engine, outcome="error"
+        ) as labels:
+            cache_key, content = self._cache_lookup(kwargs, use_common_moderation)
+            if content is not None:
+                labels["outcome"] = "cache_hit"
                 return content
-            except openai.error.APIConnectionError as e:
-                print(
-                    f"APIConnectionError: {e}. Retrying... ({retries + 1}/{self.max_retry})"
+
+            estimated = estimate_tokens(
+                kwargs.get("prompt", ""), kwargs.get("max_tokens"), self.engine
+            )
+            res, limiter = self._create(estimated, **kwargs)
+            usage = getattr(res, "usage", None)
+            if usage:
+                metrics.inc(
+                    "promptseek_llm_tokens_total",
+                    usage.get("total_tokens", 0),
+                    engine=self.engine,
                 )
-                retries += 1
-                if retries < self.max_retry:
-                    time.sleep(2**retries)  # Exponential backoff
-                else:
-                    raise e  # すべてのリトライが失敗した場合、エラーを再度送出します
+            limiter.record_usage(
+                estimated, usage.get("total_tokens") if usage else None
+            )
+            if res.choices[0].message.content:
+                content = res.choices[0].message.content
+            else:
+                content = res.choices[0].text
+
+            if self.verbose:
+                print(content)
+            if use_common_moderation:
+                self._check_moderation(content)
+            if cache_key is not None:
+                self.cache.set(cache_key, content)
+            labels["outcome"] = "ok"
+            return content
+
+    async def aask(self, **kwargs):
+        """Async counterpart of ask, run on the default thread pool"""
+        loop = asyncio.get_running_loop()
+        # keep the caller's context (run metrics) in the worker thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            None, context.run, functools.partial(self.ask, **kwargs)
+        )
+
+    async def ask_all(self, prompts, concurrency=4, **kwargs):
+        """Ask every prompt concurrently, at most `concurrency` in flight.
+
+        Results are returned in the order of `prompts`. A failed prompt yields
+        its exception in place of the content so the others are kept.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def _ask(prompt):
+            async with semaphore:
+                return await self.aask(prompt=prompt, **kwargs)
+
+        return await asyncio.gather(
+            *[_ask(prompt) for prompt in prompts], return_exceptions=True
+        )
+
+    def ask_many(self, prompts, concurrency=4, **kwargs):
+        """Blocking counterpart of ask_all, safe to call inside a running event loop.
+
+        Results are returned in the order of `prompts`, a failed prompt yields
+        its exception in place of the content.
+        """
+
+        def _ask(prompt):
+            try:
+                return self.ask(prompt=prompt, **kwargs)
+            except Exception as e:
+                return e
+
+        if not prompts:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(prompts)))) as executor:
+            # keep the caller's context (run metrics, deadline) in every worker
+            futures = [
+                executor.submit(contextvars.copy_context().run, _ask, prompt)
+                for prompt in prompts
+            ]
+            return [future.result() for future in futures]
 
     def validate_output(self, prompt_structure, llm_response):
         """"""
         return bool, None
+
+
+class StreamResponse(object):
+    """Iterator over the content deltas of a streamed ask.
+
+    - ttft : seconds until the first delta arrived
+    - content : whole content, complete once the iteration finished
+    """
+
+    def __init__(self, wrapper, use_common_moderation, kwargs) -> None:
+        self.wrapper = wrapper
+        self.use_common_moderation = use_common_moderation
+        self.kwargs = kwargs
+        self.ttft = None
+        self.content = ""
+
+    def __iter__(self):
+        wrapper = self.wrapper
+        started_at = time.monotonic()
+        cache_key, content = wrapper._cache_lookup(
+            self.kwargs, self.use_common_moderation
+        )
+        if content is not None:
+            self.ttft = time.monotonic() - started_at
+            self.content = content
+            yield content
+            return
+
+        estimated = estimate_tokens(
+            self.kwargs.get("prompt", ""), self.kwargs.get("max_tokens"), wrapper.engine
+        )
+        chunks = []
+        response, limiter = wrapper._create(estimated, stream=True, **self.kwargs)
+        for chunk in response:
+            choice = chunk.choices[0]
+            if "delta" in choice:
+                delta = choice.delta.get("content") or ""
+            else:
+                delta = choice.get("text") or ""
+            if not delta:
+                continue
+            if self.ttft is None:
+                self.ttft = time.monotonic() - started_at
+                current_metrics().observe(
+                    "promptseek_llm_ttft_seconds", self.ttft, engine=wrapper.engine
+                )
+                if wrapper.verbose:
+                    print(f"[time to first token: {self.ttft:.2f}s]")
+            chunks.append(delta)
+            if wrapper.verbose:
+                print(delta, end="", flush=True)
+            yield delta
+        if wrapper.verbose:
+            print()
+        limiter.record_usage(estimated, None)
+        self.content = "".join(chunks)
+        if self.use_common_moderation:
+            wrapper._check_moderation(self.content)
+        if cache_key is not None:
+            wrapper.cache.set(cache_key, self.content)
@@ -0,0 +1,226 @@
+## Single-pass parsers of the PromptSeek stage responses
+"""
+Each parser reads the response line by line once and keeps the results of every
+strategy PromptSeek used so far, then picks the same one the former cascade did:
+
+- decomposition : json dict -> " P#: " headers -> "- step: description" bullets -> raw lines
+- optimization : json dict -> "[V#]: description" lines
+- redefinition : json dict -> "[Goal..." / "[V..." lines
+- step prompts (batched generation) : json / python dict -> "[O#]: prompt" lines
+
+Line based strategies work on the response stripped of surrounding whitespace,
+the " P#: " headers on the raw response, as before.
+"""
+import ast
+import json
+import re
+from typing import Dict, List, NamedTuple, Union
+
+# " P3: " header of the regular expression strategy
+_STEP_HEADER = re.compile(r" P(?:\d+|END): ")
+# "[O3]" / "O3" / "OEND" key of a batched step prompts answer
+_OUTPUT_KEY = re.compile(r"^\W*O(\d+|END)\W*$")
+# "- [O3]: prompt" / "O3 = prompt" line of a batched step prompts answer
+_OUTPUT_LINE = re.compile(r"^\W*O(\d+|END)\]?[\"']?\s*[:=]\s*(.*)$")
+
+
+class Decomposition(NamedTuple):
+    steps: List[str]
+    # dict of step -> description for " P#: " responses, list otherwise
+    variables: Union[List[str], Dict[str, str]]
+
+
+class Optimization(NamedTuple):
+    variables_description: Dict[str, str]
+
+
+class Redefinition(NamedTuple):
+    goal_contents: List[str]
+    variables: List[str]
+
+
+class StepPrompts(NamedTuple):
+    # step index -> its prompt, steps missing or malformed in the answer are absent
+    prompts: Dict[int, str]
+
+
+def _json_dict(text):
+    """The response as a dict when it is a json object, else None"""
+    if text.lstrip()[:1] != "{":
+        return None
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _stripped_bounds(lines):
+    """First and last line of text.strip(), (0, -1) when the text is blank"""
+    first = 0
+    last = len(lines) - 1
+    while first <= last and not lines[first].strip():
+        first += 1
+    while last >= first and not lines[last].strip():
+        last -= 1
+    return first, last
+
+
+def _stripped_lines(text):
+    """text.strip().split("\\n") without copying the whole text first"""
+    lines = text.split("\n")
+    first, last = _stripped_bounds(lines)
+    if first > last:
+        return [""]
+    lines = lines[first : last + 1]
+    lines[0] = lines[0].lstrip()
+    lines[-1] = lines[-1].rstrip()
+    return lines
+
+
+def parse_decomposition(text: str) -> Decomposition:
+    data = _json_dict(text)
+    if data is not None:
+        steps = data.get("steps", [])
+        variables = data.get("variables", [])
+        if steps and variables:
+            return Decomposition(steps, variables)
+
+    lines = text.split("\n")
+    first, last = _stripped_bounds(lines)
+    has_newline = len(lines) - 1
+
+    # " P#: " headers, the description is the whole next line
+    header_steps = []
+    header_descriptions = []
+    description_line = -1
+    # "- step: description" bullets
+    bullet_steps = []
+    bullet_variables = []
+    mode = ""
+
+    for i in range(first, last + 1):
+        raw = lines[i]
+
+        if data is None and i < has_newline and " P" in raw:
+            match = _STEP_HEADER.search(raw)
+            if match:
+                header_steps.append(raw[match.end() :])
+                # a description line is not searched for headers again
+                if i != description_line:
+                    header_descriptions.append(lines[i + 1].strip())
+                    description_line = i + 1
+
+        line = raw
+        if i == first:
+            line = line.lstrip()
+        if i == last:
+            line = line.rstrip()
+        if "- " not in line:
+            continue
+        if ":" in line:
+            parts = line.split(":")
+            if mode != "-to[":
+                bullet_steps.append(parts[-2].strip())
+            bullet_variables.append(parts[-1].strip())
+        else:
+            if not bullet_steps:
+                mode = "-to["
+            if mode == "-to[":
+                bullet_steps.append(line.replace("- ", "").strip())
+            else:
+                bullet_variables.append(line.replace("- ", "").strip())
+
+    if data is None:
+        variables = dict(zip(header_steps, header_descriptions))
+        if header_steps and variables:
+            return Decomposition(header_steps, variables)
+    if bullet_steps and bullet_variables:
+        return Decomposition(bullet_steps, bullet_variables)
+
+    # last resort: characters of the second line, then the remaining lines
+    stripped = _stripped_lines(text)
+    return Decomposition(list(stripped[1]) if len(stripped) > 1 else [], stripped[2:])
+
+
+def parse_optimization(text: str) -> Optimization:
+    data = _json_dict(text)
+    if data is not None:
+        return Optimization(data.get("variables_description", {}))
+
+    variables_description = {}
+    for line in _stripped_lines(text):
+        if line.startswith("[V") and ":" in line:
+            var_name, description = line.split(":", 1)
+            variables_description[var_name.strip()] = description.strip()
+    return Optimization(variables_description)
+
+
+def parse_redefinition(text: str) -> Redefinition:
+    data = _json_dict(text)
+    if data is not None:
+        return Redefinition(data.get("goal_contents", ""), data.get("variables", []))
+
+    goal_contents = []
+    variables = []
+    for line in _stripped_lines(text):
+        if line.startswith("[Goal"):
+            goal_contents.append(line)
+        elif line.startswith("[V"):
+            variables.append(line)
+    return Redefinition(goal_contents, variables)
+
+
+def _embedded_dict(text):
+    """The first {...} block of the text as a dict (json or python literal), else None"""
+    start = text.find("{")
+    end = text.rfind("}")
+    if start < 0 or end < start:
+        return None
+    block = text[start : end + 1]
+    for load in (json.loads, ast.literal_eval):
+        try:
+            data = load(block)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            continue
+        if isinstance(data, dict):
+            return data
+    return None
+
+
+def _step_index(key, count):
+    """Index of the step of an "O#" key, None when it is not a step of 0..count-1"""
+    if isinstance(key, int):
+        index = key
+    else:
+        match = _OUTPUT_KEY.match(str(key).strip())
+        if not match:
+            return None
+        index = count - 1 if match.group(1) == "END" else int(match.group(1))
+    return index if 0 <= index < count else None
+
+
+def parse_step_prompts(text: str, count: int) -> StepPrompts:
+    """Step prompts of one answer covering `count` steps, keyed O0 .. O{count-1} or OEND"""
+    prompts = {}
+    data = _embedded_dict(text)
+    if data is not None:
+        for key, value in data.items():
+            index = _step_index(key, count)
+            if index is not None and isinstance(value, str) and value.strip():
+                prompts[index] = value.strip()
+        return StepPrompts(prompts)
+
+    # "[O#]: prompt" lines, a prompt goes on until the next key
+    current = None
+    for line in _stripped_lines(text):
+        match = _OUTPUT_LINE.match(line)
+        if match:
+            index = count - 1 if match.group(1) == "END" else int(match.group(1))
+            current = index if 0 <= index < count else None
+            if current is not None:
+                prompts[current] = [match.group(2)]
+        elif current is not None:
+            prompts[current].append(line)
+    prompts = {i: "\n".join(lines).strip() for i, lines in prompts.items()}
+    return StepPrompts({i: prompt for i, prompt in prompts.items() if prompt})
@@ -0,0 +1,195 @@
+## Shared rate limiter and retry policy for OpenAIWrapper
+import random
+import threading
+import time
+
+import openai
+
+import PromptSeeker.modules.config as CONFIG
+from PromptSeeker.modules.tokens import count_message_tokens
+
+
+class TokenBucket(object):
+    """Bucket refilled continuously at `rate` units per second up to `capacity`.
+
+    Reservations may drive the level below zero, the caller then waits until
+    the debt is refilled. This keeps requests in arrival order.
+    """
+
+    def __init__(self, capacity, rate) -> None:
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.level = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount, now):
+        """Take `amount` and return the seconds to wait before it is covered"""
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate
+
+    def wait(self, amount, now):
+        """Seconds `amount` would wait, without taking it"""
+        self._refill(now)
+        level = self.level - min(amount, self.capacity)
+        return 0.0 if level >= 0 else -level / self.rate
+
+    def give_back(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter(object):
+    """Requests-per-minute and tokens-per-minute limiter shared by every caller of an engine.
+
+    - headroom : fraction of the quota actually used, keeps throughput just under it
+    - On 429 the refill rate is cut by `decrease` and calls pause for Retry-After,
+      then every successful call restores the rate by `increase` of the quota.
+    """
+
+    def __init__(
+        self, rpm, tpm, headroom=0.95, burst_seconds=10, decrease=0.5, increase=0.02
+    ) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.headroom = headroom
+        self.decrease = decrease
+        self.increase = increase
+        self.scale = 1.0
+        request_rate = rpm * headroom / 60.0
+        token_rate = tpm * headroom / 60.0
+        self.requests = TokenBucket(max(1.0, request_rate * burst_seconds), request_rate)
+        self.tokens = TokenBucket(max(1.0, token_rate * burst_seconds), token_rate)
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _apply_scale(self):
+        self.requests.rate = self.rpm * self.headroom * self.scale / 60.0
+        self.tokens.rate = self.tpm * self.headroom * self.scale / 60.0
+
+    def acquire(self, tokens=0, timeout=None):
+        """Block until one request of `tokens` tokens fits in both quotas.
+
+        Returns False, without taking anything, when that would take more than
+        `timeout` seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if timeout is not None:
+                wait = max(
+                    self.requests.wait(1, now),
+                    self.tokens.wait(tokens, now),
+                    self.blocked_until - now,
+                )
+                if wait > timeout:
+                    return False
+            wait = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(tokens, now),
+                self.blocked_until - now,
+            )
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def wait_time(self, tokens=0):
+        """Seconds acquire(tokens) would block right now"""
+        with self._lock:
+            now = time.monotonic()
+            return max(
+                self.requests.wait(1, now),
+                self.tokens.wait(tokens, now),
+                self.blocked_until - now,
+                0.0,
+            )
+
+    def record_usage(self, estimated, actual):
+        """Correct the token bucket once the real usage of a call is known"""
+        with self._lock:
+            now = time.monotonic()
+            if actual is not None and actual != estimated:
+                self.tokens.give_back(estimated - actual, now)
+            if self.scale < 1.0:
+                self.scale = min(1.0, self.scale + self.increase)
+                self._apply_scale()
+
+    def penalize(self, retry_after=None):
+        """Server answered 429: slow down and pause everyone for Retry-After"""
+        with self._lock:
+            self.scale = max(0.05, self.scale * self.decrease)
+            self._apply_scale()
+            if retry_after:
+                self.blocked_until = max(
+                    self.blocked_until, time.monotonic() + retry_after
+                )
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def new_limiter(engine):
+    """Limiter sized from CONFIG.RATE_LIMITS of `engine`"""
+    limits = CONFIG.RATE_LIMITS.get(engine, CONFIG.RATE_LIMITS["default"])
+    return RateLimiter(rpm=limits["rpm"], tpm=limits["tpm"])
+
+
+def get_limiter(engine):
+    """Process wide limiter of `engine`, limits come from CONFIG.RATE_LIMITS"""
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(engine)
+        if limiter is None:
+            limiter = _LIMITERS[engine] = new_limiter(engine)
+        return limiter
+
+
+def estimate_tokens(prompt, max_tokens=None, engine="gpt-3.5-turbo"):
+    """Tokens a request may use: its prompt plus the completion cap"""
+    return count_message_tokens(prompt, engine) + (max_tokens or 0)
+
+
+class RetryPolicy(object):
+    """Jittered exponential backoff over the transient OpenAI errors"""
+
+    TRANSIENT_ERRORS = (
+        openai.error.APIConnectionError,
+        openai.error.RateLimitError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+        openai.error.ServiceUnavailableError,
+    )
+
+    def __init__(self, max_retry=3, base_delay=1.0, max_delay=60.0) -> None:
+        self.max_retry = max_retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_transient(self, error):
+        if isinstance(error, self.TRANSIENT_ERRORS):
+            return True
+        if isinstance(error, openai.error.APIError):
+            # 5xx or no status at all (broken stream)
+            return error.http_status is None or error.http_status >= 500
+        return False
+
+    def retry_after(self, error):
+        headers = getattr(error, "headers", None) or {}
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def delay(self, attempt, error=None):
+        """Seconds to wait before retry number `attempt` (0 origin), at most max_delay"""
+        retry_after = self.retry_after(error) if error is not None else None
+        if retry_after is not None:
+            return min(max(retry_after, 0.0), self.max_delay)
+        # full jitter: spread the retries of concurrent callers
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt + 1)))
@@ -0,0 +1,130 @@
+## Deadlines, latency percentiles for hedging and a circuit breaker for OpenAIWrapper
+import contextlib
+import contextvars
+import threading
+import time
+from collections import deque
+
+import openai
+
+from PromptSeeker.modules.metrics import current as current_metrics
+
+# monotonic time the calls of the current context must finish by
+_DEADLINE = contextvars.ContextVar("promptseek_deadline", default=None)
+
+
+class DeadlineExceeded(openai.error.Timeout):
+    """The deadline of the call (or of its stage) passed"""
+
+
+class CircuitOpenError(RuntimeError):
+    """The backend keeps failing, calls fail fast until the breaker closes again"""
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Calls made inside the block have `seconds` to finish, None adds no deadline.
+
+    Nested deadlines keep the earliest one; the deadline follows the context into
+    the threads of OpenAIWrapper.ask_many and ask_all.
+    """
+    if seconds is None:
+        yield
+        return
+    at = time.monotonic() + seconds
+    current = _DEADLINE.get()
+    token = _DEADLINE.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def remaining():
+    """Seconds left before the current deadline, None without one"""
+    at = _DEADLINE.get()
+    return None if at is None else at - time.monotonic()
+
+
+class LatencyTracker(object):
+    """Latencies of the recent calls, by kind of call (e.g. their max_tokens)"""
+
+    def __init__(self, window=200) -> None:
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind, seconds):
+        with self._lock:
+            samples = self._samples.get(kind)
+            if samples is None:
+                samples = self._samples[kind] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, kind, q, min_samples=20):
+        """q-quantile of the latencies of `kind`, None until min_samples were seen"""
+        with self._lock:
+            samples = self._samples.get(kind)
+            if samples is None or len(samples) < min_samples:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker(object):
+    """Fail fast while the backend is consistently failing.
+
+    closed : calls go through, `failure_threshold` failures in a row open the breaker
+    open : calls raise CircuitOpenError for `reset_timeout` seconds
+    half open : one probe call goes through, its success closes the breaker, its failure reopens it
+
+    Every opening counts in the promptseek_circuit_opened_total metric.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, name="openai") -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go out now"""
+        with self._lock:
+            if self.state == "closed":
+                return
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            wait = max(0.0, self.reset_timeout - (now - self.opened_at))
+            raise CircuitOpenError(
+                f"backend failing, circuit {self.state} (retry in {wait:.0f}s)"
+            )
+
+    def record(self, failed):
+        """Report the outcome of a call let through, failed=None when it never went out"""
+        with self._lock:
+            if failed is None:
+                self._probing = False
+                return
+            if not failed:
+                self.state = "closed"
+                self.failures = 0
+                self._probing = False
+                return
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    current_metrics().inc(
+                        "promptseek_circuit_opened_total", breaker=self.name
+                    )
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._probing = False
@@ -0,0 +1,66 @@
+## Run the stages of an iteration as a graph, independent stages at the same time
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def stage_dependencies(stage_io, order):
+    """{stage: set of earlier stages it has to wait for}
+
+    A stage waits for an earlier one when it reads what the earlier stage writes,
+    writes what it reads or writes the same attribute. "after" lists extra
+    dependencies that are not attributes (e.g. save needs every stage).
+    """
+    dependencies = {}
+    for i, stage in enumerate(order):
+        reads = set(stage_io[stage]["reads"])
+        writes = set(stage_io[stage]["writes"])
+        dependencies[stage] = set(stage_io[stage].get("after", ()))
+        for earlier in order[:i]:
+            earlier_reads = set(stage_io[earlier]["reads"])
+            earlier_writes = set(stage_io[earlier]["writes"])
+            if (
+                reads & earlier_writes
+                or writes & earlier_reads
+                or writes & earlier_writes
+            ):
+                dependencies[stage].add(earlier)
+    return dependencies
+
+
+def run_stages(order, dependencies, run, done=(), max_workers=None):
+    """Run every stage of `order` not in `done` with run(stage) once its dependencies finished.
+
+    Ready stages run concurrently on threads, each in a copy of the caller's
+    context. After a failure no new stage starts; the running ones finish,
+    then the first error is raised. Returns the stages completed in this call.
+    """
+    done = set(done)
+    pending = [stage for stage in order if stage not in done]
+    completed = []
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers or len(order)) as executor:
+        while pending or running:
+            if error is None:
+                for stage in list(pending):
+                    if dependencies[stage] <= done:
+                        pending.remove(stage)
+                        context = contextvars.copy_context()
+                        running[executor.submit(context.run, run, stage)] = stage
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    future.result()
+                except BaseException as e:
+                    error = error or e
+                else:
+                    done.add(stage)
+                    completed.append(stage)
+    if error is not None:
+        raise error
+    if pending:
+        raise ValueError(f"stages {pending} wait for stages that never run")
+    return completed
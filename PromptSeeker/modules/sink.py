@@ -0,0 +1,38 @@
+## Output sinks for saved PromptSeek runs
+import json
+import os
+import sys
+import threading
+
+from PromptSeeker.modules.state import write_json
+
+
+class JsonlSink(object):
+    """Append every saved run as one JSON line of a single file ("-" is stdout)"""
+
+    def __init__(self, path) -> None:
+        self.path = path
+        if path == "-":
+            self.file = sys.stdout
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def write_items(self, items):
+        """write(dict(items)), encoded value by value straight into the file"""
+        with self._lock:
+            write_json(items, self.file, ensure_ascii=False)
+            self.file.write("\n")
+            self.file.flush()
+
+    def close(self):
+        with self._lock:
+            if self.file is not sys.stdout:
+                self.file.close()
@@ -0,0 +1,369 @@
+## Compact run state of PromptSeek: compressed raw responses, iteration snapshots, streamed JSON
+import bisect
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import types
+import zlib
+from collections import deque
+from typing import Any, NamedTuple, Tuple
+
+# texts of at least this many bytes are kept zlib compressed
+COMPRESS_THRESHOLD = 512
+
+
+class SpillFile(object):
+    """File holding compressed texts moved out of memory.
+
+    Shared by many runs (e.g. every seek of a batch), read back by (offset, size).
+    The space of a blob given back with free() is reused by the next ones, and
+    the file is truncated when its tail is free.
+    """
+
+    def __init__(self, path=None, dir=None) -> None:
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="promptseek-", suffix=".spill", dir=dir)
+            os.close(fd)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._end = os.fstat(self._fd).st_size
+        # free (offset, size) extents, sorted and coalesced
+        self._free = []
+        # freed blobs not yet merged into _free, appended without the lock
+        # since free() runs from the __del__ of the blobs
+        self._released = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._end
+
+    def put(self, data):
+        with self._lock:
+            self._merge_released()
+            offset = self._allocate(len(data))
+            os.pwrite(self._fd, data, offset)
+        return offset, len(data)
+
+    def get(self, offset, size):
+        return os.pread(self._fd, size, offset)
+
+    def free(self, offset, size):
+        """Give back the space of a blob nobody reads anymore"""
+        self._released.append((offset, size))
+
+    def _allocate(self, size):
+        # first fit in the free extents, else at the end of the file
+        for i, (offset, free) in enumerate(self._free):
+            if free >= size:
+                if free == size:
+                    del self._free[i]
+                else:
+                    self._free[i] = (offset + size, free - size)
+                return offset
+        offset = self._end
+        self._end += size
+        return offset
+
+    def _merge_released(self):
+        truncated = False
+        while self._released:
+            offset, size = self._released.popleft()
+            i = bisect.bisect(self._free, (offset, size))
+            if i < len(self._free) and offset + size == self._free[i][0]:
+                size += self._free.pop(i)[1]
+            if i and sum(self._free[i - 1]) == offset:
+                offset, previous = self._free.pop(i - 1)
+                size += previous
+                i -= 1
+            self._free.insert(i, (offset, size))
+        while self._free and sum(self._free[-1]) == self._end:
+            self._end = self._free.pop()[0]
+            truncated = True
+        if truncated:
+            os.ftruncate(self._fd, self._end)
+
+    def close(self, remove=True):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SpilledBlob(object):
+    """Blob written to a SpillFile, its space is freed with the object"""
+
+    __slots__ = ("spill", "offset", "size")
+
+    def __init__(self, spill, data) -> None:
+        self.spill = spill
+        self.offset, self.size = spill.put(data)
+
+    def read(self):
+        return self.spill.get(self.offset, self.size)
+
+    def __del__(self):
+        self.spill.free(self.offset, self.size)
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class CompactText(object):
+    """Immutable text kept zlib compressed, in memory or in a SpillFile"""
+
+    __slots__ = ("_blob", "digest")
+
+    def __init__(self, text, spill=None) -> None:
+        data = text.encode("utf-8")
+        self.digest = _digest(data)
+        blob = zlib.compress(data)
+        self._blob = blob if spill is None else SpilledBlob(spill, blob)
+
+    @property
+    def text(self):
+        blob = self._blob if isinstance(self._blob, bytes) else self._blob.read()
+        return zlib.decompress(blob).decode("utf-8")
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f"CompactText({self.text[:40]!r}...)"
+
+
+def compact(text, spill=None, threshold=COMPRESS_THRESHOLD, reuse=()):
+    """`text` as it should be stored: itself when short, else a CompactText.
+
+    A CompactText of `reuse` holding the same text is returned instead of a new
+    one, so an unchanged text is not compressed (and spilled) again.
+    """
+    if not isinstance(text, str) or len(text) < threshold:
+        return text
+    candidates = [value for value in reuse if isinstance(value, CompactText)]
+    if candidates:
+        digest = _digest(text.encode("utf-8"))
+        for value in candidates:
+            if value.digest == digest:
+                return value
+    return CompactText(text, spill)
+
+
+def as_text(value):
+    """Inverse of compact"""
+    return value.text if isinstance(value, CompactText) else value
+
+
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, dict):
+        return types.MappingProxyType(dict(value))
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, tuple):
+        return list(value)
+    if isinstance(value, types.MappingProxyType):
+        return dict(value)
+    return value
+
+
+class IterationSnapshot(NamedTuple):
+    """Read-only state at the end of one iteration, raw texts stay compact"""
+
+    process_count: int
+    goal_contents: Tuple[Any, ...]
+    decomposed_steps: Tuple[Any, ...]
+    variables: Any
+    variables_description: Any
+    step_prompts: Tuple[Any, ...]
+    plane_decomposition: Any
+    plane_optimization: Any
+    plane_redefinition: Any
+    plane_step_prompts: Any
+
+    def to_dict(self):
+        record = {}
+        for field, value in zip(self._fields, self):
+            if field == "step_prompts":
+                value = [as_text(p) for p in value]
+            record[field] = _thaw(as_text(value))
+        return record
+
+
+_PLANE_FIELDS = (
+    "plane_decomposition",
+    "plane_optimization",
+    "plane_redefinition",
+    "plane_step_prompts",
+)
+
+
+def _compact_property(slot):
+    def getter(self):
+        return as_text(getattr(self, slot))
+
+    def setter(self, value):
+        setattr(
+            self,
+            slot,
+            compact(value, self.spill, self.threshold, reuse=(getattr(self, slot),)),
+        )
+
+    return property(getter, setter)
+
+
+class RunState(object):
+    """Mutable state of a PromptSeek run.
+
+    Raw responses and step prompts are stored through compact(), so they are
+    compressed (and spilled to `spill` when given) and decompressed on access.
+    Overwritten texts free their spill space once no snapshot holds them.
+    """
+
+    __slots__ = (
+        "spill",
+        "threshold",
+        "goal_contents",
+        "decomposed_steps",
+        "variables",
+        "variables_description",
+        "step_groups",
+        "generated_steps",
+        "failed_steps",
+        "process_count",
+        "_step_prompts",
+    ) + tuple("_" + field for field in _PLANE_FIELDS)
+
+    def __init__(self, spill=None, threshold=COMPRESS_THRESHOLD) -> None:
+        self.spill = spill
+        self.threshold = threshold
+        self.goal_contents = []
+        self.decomposed_steps = []
+        self.variables = []
+        self.variables_description = {}
+        self.step_groups = []
+        self.generated_steps = []
+        self.failed_steps = []
+        self.process_count = 0
+        self._step_prompts = ()
+        for field in _PLANE_FIELDS:
+            setattr(self, "_" + field, "")
+
+    plane_decomposition = _compact_property("_plane_decomposition")
+    plane_optimization = _compact_property("_plane_optimization")
+    plane_redefinition = _compact_property("_plane_redefinition")
+    plane_step_prompts = _compact_property("_plane_step_prompts")
+
+    @property
+    def step_prompts(self):
+        """tuple of the prompts, assign a new sequence to change them"""
+        return tuple(as_text(p) for p in self._step_prompts)
+
+    @step_prompts.setter
+    def step_prompts(self, prompts):
+        previous = self._step_prompts
+        self._step_prompts = tuple(
+            compact(p, self.spill, self.threshold, reuse=previous) for p in prompts
+        )
+
+    def snapshot(self):
+        """IterationSnapshot sharing the compact texts of the current state"""
+        return IterationSnapshot(
+            process_count=self.process_count,
+            goal_contents=_freeze(self.goal_contents),
+            decomposed_steps=_freeze(self.decomposed_steps),
+            variables=_freeze(self.variables),
+            variables_description=_freeze(self.variables_description),
+            step_prompts=self._step_prompts,
+            plane_decomposition=self._plane_decomposition,
+            plane_optimization=self._plane_optimization,
+            plane_redefinition=self._plane_redefinition,
+            plane_step_prompts=self._plane_step_prompts,
+        )
+
+
+class StateAttribute(object):
+    """Attribute of an object delegated to the same attribute of its `state`"""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return getattr(obj.state, self.name)
+
+    def __set__(self, obj, value):
+        setattr(obj.state, self.name, value)
+
+
+class RunHistory(object):
+    """Snapshots of the completed iterations.
+
+    The last `keep` stay in memory; older ones are written to `spill` and read
+    back on access, or dropped when there is no spill file.
+    """
+
+    def __init__(self, keep=2, spill=None) -> None:
+        self.keep = keep
+        self.spill = spill
+        # IterationSnapshot in memory, SpilledBlob in the spill file, or None when dropped
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def append(self, snapshot):
+        with self._lock:
+            self._entries.append(snapshot)
+            old = len(self._entries) - self.keep - 1
+            if old >= 0 and isinstance(self._entries[old], IterationSnapshot):
+                self._entries[old] = self._evict(self._entries[old])
+
+    def _evict(self, snapshot):
+        if self.spill is None:
+            return None
+        data = json.dumps(snapshot.to_dict(), ensure_ascii=False).encode("utf-8")
+        return SpilledBlob(self.spill, zlib.compress(data))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        entry = self._entries[index]
+        if entry is None:
+            raise KeyError(f"iteration {index} was dropped from the history")
+        if isinstance(entry, IterationSnapshot):
+            return entry
+        record = json.loads(zlib.decompress(entry.read()).decode("utf-8"))
+        return IterationSnapshot(
+            **{
+                field: tuple(value) if field == "step_prompts" else _freeze(value)
+                for field, value in record.items()
+            }
+        )
+
+    def __iter__(self):
+        for index in range(len(self._entries)):
+            if self._entries[index] is not None:
+                yield self[index]
+
+
+def write_json(items, f, ensure_ascii=True):
+    """json.dump(dict(items), f) written value by value, without building the dict"""
+    encoder = json.JSONEncoder(ensure_ascii=ensure_ascii)
+    f.write("{")
+    for i, (key, value) in enumerate(items):
+        if i:
+            f.write(", ")
+        f.write(encoder.encode(key))
+        f.write(": ")
+        for chunk in encoder.iterencode(value):
+            f.write(chunk)
+    f.write("}")
@@ -0,0 +1,209 @@
+## Indexed SQLite store of PromptSeek results
+"""
+python3 -m PromptSeeker.modules.store import retults/prompt_seeks/ --db results/results.sqlite3
+python3 -m PromptSeeker.modules.store latest "To build FastAPI application pytest generator."
+python3 -m PromptSeeker.modules.store search "pytest fixture"
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = "./results/results.sqlite3"
+
+# <YYYYmmddHHMMSS><goal><save_name> written by PromptSeek.save
+_SAVED_FILE_NAME = re.compile(r"^(\d{14})(.*)$")
+
+
+def _fts_phrases(query):
+    """`query` as FTS5 phrases, one per word, so quotes / - / : / * / ( ) are plain text"""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+class ResultStore(object):
+    """SQLite store of saved runs, indexed on goal, time and iteration.
+
+    Step prompts are indexed with FTS5 when the SQLite build has it.
+    Usable as the sink of PromptSeek: PromptSeek(..., sink=ResultStore()).
+    """
+
+    def __init__(self, path=DEFAULT_PATH) -> None:
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                goal TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                process_count INTEGER,
+                source TEXT UNIQUE,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS runs_goal_created_at ON runs(goal, created_at);
+            CREATE INDEX IF NOT EXISTS runs_created_at ON runs(created_at);
+            CREATE INDEX IF NOT EXISTS runs_process_count ON runs(process_count);
+            """
+        )
+        try:
+            self.db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS step_prompts_fts "
+                "USING fts5(step_prompts, content='')"
+            )
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            self.has_fts = False
+        self.db.commit()
+
+    def write(self, record, created_at=None, source=None):
+        """Store one saved run, returns its id (None if `source` was already imported)"""
+        created_at = time.time() if created_at is None else created_at
+        step_prompts = "\n".join(p for p in record.get("step_prompts") or [] if p)
+        with self._lock:
+            cur = self.db.execute(
+                "INSERT OR IGNORE INTO runs (goal, created_at, process_count, source, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    record.get("goal", ""),
+                    created_at,
+                    record.get("process_count"),
+                    source,
+                    json.dumps(record, ensure_ascii=False),
+                ),
+            )
+            run_id = cur.lastrowid if cur.rowcount else None
+            if run_id is not None and self.has_fts and step_prompts:
+                self.db.execute(
+                    "INSERT INTO step_prompts_fts (rowid, step_prompts) VALUES (?, ?)",
+                    (run_id, step_prompts),
+                )
+            self.db.commit()
+        return run_id
+
+    def _load(self, row):
+        record = json.loads(row["data"])
+        record["_id"] = row["id"]
+        record["_created_at"] = row["created_at"]
+        return record
+
+    def get(self, run_id):
+        with self._lock:
+            row = self.db.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        return self._load(row) if row is not None else None
+
+    def latest(self, goal):
+        """Latest saved run of `goal`, None if there is none"""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT * FROM runs WHERE goal = ? ORDER BY created_at DESC, id DESC LIMIT 1",
+                (goal,),
+            ).fetchone()
+        return self._load(row) if row is not None else None
+
+    def runs(self, goal=None, process_count=None, since=None, limit=100):
+        """Saved runs, newest first, filtered on goal / iteration / time"""
+        query = "SELECT * FROM runs WHERE 1 = 1"
+        params = []
+        if goal is not None:
+            query += " AND goal = ?"
+            params.append(goal)
+        if process_count is not None:
+            query += " AND process_count = ?"
+            params.append(process_count)
+        if since is not None:
+            query += " AND created_at >= ?"
+            params.append(since)
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [self._load(row) for row in rows]
+
+    def goals(self):
+        """Every goal with its number of runs and latest time"""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT goal, COUNT(*) AS runs, MAX(created_at) AS latest "
+                "FROM runs GROUP BY goal ORDER BY latest DESC"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def search(self, query, limit=20):
+        """Runs whose step prompts contain every word of the plain text `query`"""
+        with self._lock:
+            if self.has_fts and _fts_phrases(query):
+                rows = self.db.execute(
+                    "SELECT runs.* FROM step_prompts_fts "
+                    "JOIN runs ON runs.id = step_prompts_fts.rowid "
+                    "WHERE step_prompts_fts MATCH ? ORDER BY rank LIMIT ?",
+                    (_fts_phrases(query), limit),
+                ).fetchall()
+            else:
+                rows = self.db.execute(
+                    "SELECT * FROM runs WHERE data LIKE ? ORDER BY created_at DESC LIMIT ?",
+                    (f"%{query}%", limit),
+                ).fetchall()
+        return [self._load(row) for row in rows]
+
+    def import_directory(self, save_dir):
+        """Import the JSON files written by PromptSeek.save, returns the number imported"""
+        imported = 0
+        for name in sorted(os.listdir(save_dir)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(save_dir, name)
+            match = _SAVED_FILE_NAME.match(name)
+            if match:
+                created_at = time.mktime(time.strptime(match.group(1), "%Y%m%d%H%M%S"))
+            else:
+                created_at = os.path.getmtime(path)
+            with open(path, encoding="utf-8") as f:
+                record = json.load(f)
+            if self.write(record, created_at=created_at, source=os.path.abspath(path)):
+                imported += 1
+        return imported
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PromptSeek results store")
+    parser.add_argument("--db", default=DEFAULT_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("import", help="import a directory of saved JSON")
+    command.add_argument("save_dir")
+    command = commands.add_parser("latest", help="latest run of a goal")
+    command.add_argument("goal")
+    command = commands.add_parser("search", help="full-text search over step prompts")
+    command.add_argument("query")
+    command.add_argument("--limit", type=int, default=20)
+    commands.add_parser("goals", help="list the stored goals")
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.db)
+    try:
+        if args.command == "import":
+            print(f"imported {store.import_directory(args.save_dir)} runs")
+        elif args.command == "latest":
+            print(json.dumps(store.latest(args.goal), ensure_ascii=False, indent=2))
+        elif args.command == "search":
+            for record in store.search(args.query, limit=args.limit):
+                print(f"{record['_id']}\t{record.get('process_count')}\t{record['goal']}")
+        elif args.command == "goals":
+            for goal in store.goals():
+                print(f"{goal['runs']}\t{goal['goal']}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+## Offline token counting and message compaction
+"""
+tiktoken downloads the BPE file of an encoding on first use. To count offline,
+fill its cache once on a machine with network and point TIKTOKEN_CACHE_DIR at it:
+
+TIKTOKEN_CACHE_DIR=./results/tiktoken python3 -c "import tiktoken; tiktoken.get_encoding('cl100k_base')"
+export TIKTOKEN_CACHE_DIR=./results/tiktoken
+
+Without it, counts fall back to an approximation, reported once per engine.
+"""
+import re
+import threading
+
+# tiktoken encodings by engine, None when tiktoken or its BPE file is unavailable
+_ENCODINGS = {}
+_ENCODINGS_LOCK = threading.Lock()
+
+# GPT-2 style pre-tokenization, used to approximate counts without tiktoken
+_PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+")
+
+# tokens added around every chat message and before the reply (gpt-3.5-turbo / gpt-4)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+ELLIPSIS = "\n...\n"
+
+
+def get_encoding(engine):
+    with _ENCODINGS_LOCK:
+        if engine not in _ENCODINGS:
+            try:
+                import tiktoken
+
+                _ENCODINGS[engine] = tiktoken.encoding_for_model(engine)
+            except Exception as e:
+                # not installed, unknown engine or the BPE file cannot be loaded offline
+                print(
+                    f"tiktoken unavailable for {engine} ({type(e).__name__}), token counts are "
+                    "approximated; see TIKTOKEN_CACHE_DIR in tokens.py to count offline"
+                )
+                _ENCODINGS[engine] = None
+        return _ENCODINGS[engine]
+
+
+def count_tokens(text, engine="gpt-3.5-turbo"):
+    encoding = get_encoding(engine)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # long words are split into several tokens, about 4 characters each
+    return sum(1 + (len(piece) - 1) // 4 for piece in _PIECES.findall(text))
+
+
+def count_message_tokens(messages, engine="gpt-3.5-turbo"):
+    """Tokens of a prompt, either a chat messages list or a plain string"""
+    if isinstance(messages, str):
+        return count_tokens(messages, engine)
+    return TOKENS_PER_REPLY + sum(
+        TOKENS_PER_MESSAGE + count_tokens(m.get("content") or "", engine)
+        for m in messages
+    )
+
+
+def truncate_tokens(text, max_tokens, engine="gpt-3.5-turbo"):
+    """Head of `text` holding at most `max_tokens` tokens"""
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(engine)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    kept = 0
+    end = 0
+    for match in _PIECES.finditer(text):
+        piece = match.group(0)
+        kept += 1 + (len(piece) - 1) // 4
+        if kept > max_tokens:
+            break
+        end = match.end()
+    return text[:end]
+
+
+def compact_text(text, max_tokens, engine="gpt-3.5-turbo"):
+    """Fit `text` in `max_tokens`, keeping its first lines (the instructions)
+    and its last lines (the most recent context) and dropping the stale middle
+    """
+    if count_tokens(text, engine) <= max_tokens:
+        return text
+    lines = text.split("\n")
+    budget = max_tokens - count_tokens(ELLIPSIS, engine)
+    head, tail = [], []
+    used = 0
+    for line in lines:
+        cost = count_tokens(line + "\n", engine)
+        if used + cost > budget // 2:
+            break
+        head.append(line)
+        used += cost
+    for line in reversed(lines[len(head) :]):
+        cost = count_tokens(line + "\n", engine)
+        if used + cost > budget:
+            break
+        tail.append(line)
+        used += cost
+    if not head and not tail:
+        return truncate_tokens(text, max_tokens, engine)
+    return "\n".join(head) + ELLIPSIS + "\n".join(reversed(tail))
+
+
+def compact_messages(messages, max_input_tokens, engine="gpt-3.5-turbo"):
+    """Fit a chat prompt in `max_input_tokens`.
+
+    The system rule and the final user request are kept, the context messages
+    in between are compacted largest first. Returns a new list.
+    """
+    total = count_message_tokens(messages, engine)
+    if isinstance(messages, str) or total <= max_input_tokens:
+        return messages
+    messages = [dict(m) for m in messages]
+    context = sorted(
+        range(1, len(messages) - 1),
+        key=lambda i: count_tokens(messages[i].get("content") or "", engine),
+        reverse=True,
+    )
+    for i in context:
+        excess = total - max_input_tokens
+        if excess <= 0:
+            break
+        content = messages[i].get("content") or ""
+        size = count_tokens(content, engine)
+        messages[i]["content"] = compact_text(content, max(size - excess, 0), engine)
+        total += count_tokens(messages[i]["content"], engine) - size
+    if total > max_input_tokens:
+        # still too long: cut the final request itself
+        last = messages[-1].get("content") or ""
+        size = count_tokens(last, engine)
+        messages[-1]["content"] = truncate_tokens(
+            last, max(size - (total - max_input_tokens), 0), engine
+        )
+    return messages
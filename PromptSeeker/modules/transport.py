@@ -0,0 +1,36 @@
+## Keep-alive HTTP transport shared by every thread calling the openai module
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 32
+
+_SESSION_LOCK = threading.Lock()
+
+
+def pooled_session(pool_size=DEFAULT_POOL_SIZE, max_retries=2):
+    """requests.Session keeping up to `pool_size` connections per host alive"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def install_session(openai_module, session=None):
+    """Route the requests of `openai_module` through one pooled session.
+
+    openai otherwise opens a new session (and TLS handshake) per thread.
+    The session is process-wide: every OpenAIWrapper shares it, credentials
+    are passed with every call. openai keeps the session a thread got on its
+    first request, so give your own `session` before any request is made.
+    """
+    with _SESSION_LOCK:
+        if session is not None:
+            openai_module.requestssession = session
+        elif getattr(openai_module, "requestssession", None) is None:
+            openai_module.requestssession = pooled_session()
+        return openai_module.requestssession
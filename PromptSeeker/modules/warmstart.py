@@ -0,0 +1,72 @@
+## Nearest prior run of a goal, to warm start PromptSeek
+import threading
+
+import numpy as np
+
+from PromptSeeker.modules.embeddings import embed_texts
+
+
+class GoalIndex(object):
+    """Brute-force cosine index over the goals of past runs.
+
+    Each entry keeps the final decomposed_steps / step_prompts of its goal.
+    - embed : function(texts) -> L2 normalized vectors, defaults to sentence-transformers
+    """
+
+    def __init__(self, embed=None) -> None:
+        self.embed = embed or embed_texts
+        self.goals = []
+        self.records = []
+        self.vectors = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_store(cls, store, embed=None):
+        """Index the latest run with a decomposition of every goal of a ResultStore"""
+        index = cls(embed=embed)
+        goals, records = [], []
+        for goal in store.goals():
+            for record in store.runs(goal=goal["goal"], limit=10):
+                if record.get("decomposed_steps"):
+                    goals.append(goal["goal"])
+                    records.append(record)
+                    break
+        index.add_many(goals, records)
+        return index
+
+    def add_many(self, goals, records):
+        if not goals:
+            return
+        vectors = np.asarray(self.embed(list(goals)), dtype=np.float32)
+        with self._lock:
+            self.goals.extend(goals)
+            self.records.extend(
+                {
+                    "goal": r.get("goal"),
+                    "decomposed_steps": r.get("decomposed_steps", []),
+                    "step_prompts": r.get("step_prompts", []),
+                }
+                for r in records
+            )
+            if self.vectors is None:
+                self.vectors = vectors
+            else:
+                self.vectors = np.vstack([self.vectors, vectors])
+
+    def add(self, goal, record):
+        self.add_many([goal], [record])
+
+    def lookup(self, goal, threshold=0.85):
+        """(similarity, record) of the closest prior goal above threshold, else None"""
+        with self._lock:
+            if self.vectors is None or not len(self.goals):
+                return None
+            vectors = self.vectors
+            records = self.records
+        query = np.asarray(self.embed([goal]), dtype=np.float32)[0]
+        similarities = vectors @ query
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < threshold:
+            return None
+        return similarity, records[best]
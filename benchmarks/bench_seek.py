@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""End-to-end benchmark of PromptSeek on the deterministic fake LLM
+
+python3 benchmarks/bench_seek.py --runs 20 --latency lognormal:0.05,0.3
+python3 benchmarks/bench_seek.py --mode auto --max-process 3 --error-rate 0.05 --concurrency 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from PromptSeeker.models.promptseek import PromptSeek
+from PromptSeeker.modules.fakellm import FakeOpenAI, LatencyModel
+from PromptSeeker.modules.keypool import ApiKey, KeyPool
+from PromptSeeker.modules.metrics import METRICS
+from PromptSeeker.modules.openaiwappper import OpenAIWrapper
+from PromptSeeker.modules.parser import (
+    parse_decomposition,
+    parse_optimization,
+    parse_redefinition,
+)
+from PromptSeeker.modules.ratelimit import RateLimiter, RetryPolicy
+from PromptSeeker.modules.sink import JsonlSink
+from PromptSeeker.modules.store import ResultStore
+
+GOAL = "To build FastAPI application pytest generator."
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def build_wrapper(args):
+    backend = FakeOpenAI(
+        corpus_dirs=[os.path.join(ROOT, "retults", "prompt_seeks")],
+        latency=LatencyModel(args.latency),
+        token_latency=args.token_latency,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    # the limiter is sized out of the way, the benchmark measures the pipeline
+    limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm)
+    key_pool = None
+    if args.keys > 1:
+        # every key gets the same quota, throughput should scale with --keys
+        key_pool = KeyPool(
+            [
+                ApiKey(
+                    f"fake-{i}",
+                    name=f"fake-{i}",
+                    rate_limiter=RateLimiter(rpm=args.rpm, tpm=args.tpm),
+                )
+                for i in range(args.keys)
+            ]
+        )
+    wrapper = OpenAIWrapper(
+        backend=backend,
+        rate_limiter=limiter,
+        key_pool=key_pool,
+        retry_policy=RetryPolicy(max_retry=5, base_delay=0.01, max_delay=0.1),
+        verbose=False,
+        request_timeout=args.request_timeout,
+        hedge_percentile=args.hedge_percentile,
+    )
+    return backend, wrapper
+
+
+def run_once(args, wrapper, sink, i):
+    prompt_seek = PromptSeek(
+        goal=f"{GOAL} #{i}",
+        llm_wrapper=wrapper,
+        max_process=args.max_process,
+        step_concurrency=args.step_concurrency,
+        stream=args.stream,
+        sink=sink,
+        moderation=args.moderation,
+        parallel_stages=not args.sequential_stages,
+        batch_steps=args.batch_steps,
+    )
+    started_at = time.perf_counter()
+    if args.mode == "auto":
+        prompt_seek.seek()
+        prompt_seek.auto_seek()
+    else:
+        prompt_seek.seek()
+    return time.perf_counter() - started_at, prompt_seek
+
+
+def bench_parse(seeks, repeat=50):
+    texts = []
+    for seek in seeks:
+        texts.append((parse_decomposition, seek.plane_decomposition))
+        texts.append((parse_optimization, seek.plane_optimization))
+        texts.append((parse_redefinition, seek.plane_redefinition))
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        for parse, text in texts:
+            parse(text)
+    return (time.perf_counter() - started_at) / (repeat * len(texts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--mode", choices=["seek", "auto"], default="seek")
+    parser.add_argument("--max-process", type=int, default=2)
+    parser.add_argument("--step-concurrency", type=int, default=4)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--sequential-stages", action="store_true")
+    parser.add_argument("--batch-steps", action="store_true")
+    parser.add_argument("--moderation", choices=["inline", "batch"], default=None)
+    parser.add_argument("--latency", default="lognormal:0.05,0.3")
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rpm", type=float, default=1e9)
+    parser.add_argument("--tpm", type=float, default=1e12)
+    parser.add_argument("--keys", type=int, default=1, help="fake API keys in a KeyPool")
+    parser.add_argument("--sink", choices=["jsonl", "store"], default="jsonl")
+    parser.add_argument("--request-timeout", type=float, default=None)
+    parser.add_argument(
+        "--hedge-percentile", type=float, default=None, help="e.g. 0.95, hedge slow calls"
+    )
+    args = parser.parse_args(argv)
+
+    backend, wrapper = build_wrapper(args)
+    METRICS.reset()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.sink == "store":
+            sink = ResultStore(os.path.join(tmp_dir, "results.sqlite3"))
+        else:
+            sink = JsonlSink(os.path.join(tmp_dir, "results.jsonl"))
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(
+                executor.map(
+                    lambda i: run_once(args, wrapper, sink, i), range(args.runs)
+                )
+            )
+        wall = time.perf_counter() - started_at
+        sink.close()
+
+    latencies = [latency for latency, _ in results]
+    seeks = [seek for _, seek in results]
+    summary = METRICS.summary()
+    timers = summary["timers"]
+
+    def timer(name):
+        return timers.get(name, {"mean": 0.0, "count": 0})
+
+    print(f"runs            : {args.runs} ({args.mode}, concurrency {args.concurrency})")
+    print(
+        f"seek latency    : p50 {percentile(latencies, 0.5):.3f}s  "
+        f"p95 {percentile(latencies, 0.95):.3f}s  p99 {percentile(latencies, 0.99):.3f}s  "
+        f"max {max(latencies):.3f}s"
+    )
+    print(f"throughput      : {args.runs / wall:.2f} seeks/s")
+    print(
+        f"llm calls       : {backend.requests} ({backend.errors} injected errors), "
+        f"{backend.requests / wall:.1f} calls/s"
+    )
+    hedges = sum(
+        value
+        for name, value in summary["counters"].items()
+        if name.startswith("promptseek_llm_hedges_total")
+    )
+    if hedges:
+        print(f"hedged calls    : {hedges:g}")
+    for stage in (
+        "decompose_goal",
+        "deduplicate_steps",
+        "optimize_variables",
+        "redefine_goal_and_variables",
+        "generate_step_prompts",
+        "save",
+    ):
+        t = timer(f'promptseek_stage_seconds{{stage="{stage}"}}')
+        print(f"stage {stage:<28}: mean {t['mean'] * 1000:8.2f}ms  (n={t['count']})")
+    print(f"parse           : {bench_parse(seeks) * 1e6:.1f}us per response")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Cold start time of the promptseek command
+
+python3 benchmarks/bench_startup.py --repeat 20
+python3 benchmarks/bench_startup.py --budget-ms 50   # exit 1 when a command without LLM calls is slower
+
+Every command runs in a fresh interpreter; the time over a bare interpreter
+(python -c pass) is what the command itself costs.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from PromptSeeker.cli import DEFAULT_SAVE_DIR
+
+# commands that never call the LLM: their cost is checked against the budget
+COMMANDS = {
+    "--help": ["-m", "PromptSeeker", "--help"],
+    "inspect-results": ["-m", "PromptSeeker", "inspect-results", DEFAULT_SAVE_DIR],
+}
+# for reference: what the LLM commands pay before their first call
+IMPORTS = {
+    "import openaiwappper": ["-c", "import PromptSeeker.modules.openaiwappper"],
+    "import promptseek": ["-c", "import PromptSeeker.models.promptseek"],
+}
+# must stay out of the commands that do not call the LLM
+HEAVY_MODULES = ("openai", "dotenv", "requests", "aiohttp", "numpy", "torch", "transformers")
+
+
+def time_command(args, repeat):
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        # inspect-results exits 1 without saved results, its start is timed all the same
+        subprocess.run(
+            [sys.executable] + args,
+            cwd=ROOT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        timings.append(time.perf_counter() - started_at)
+    return timings
+
+
+def heavy_imports(args):
+    """Heavy modules loaded by `promptseek args`"""
+    code = (
+        "import contextlib, io, sys\n"
+        "from PromptSeeker.cli import main\n"
+        "with contextlib.redirect_stdout(io.StringIO()):\n"
+        "    try:\n"
+        f"        main({args!r})\n"
+        "    except SystemExit:\n"
+        "        pass\n"
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return out.split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=None,
+        help="max median ms over the bare interpreter of the commands without LLM calls",
+    )
+    args = parser.parse_args(argv)
+
+    baseline = statistics.median(time_command(["-c", "pass"], args.repeat))
+    print(f"{'python -c pass':<24}: median {baseline * 1000:7.1f}ms")
+    over_budget = []
+    for name, command in list(COMMANDS.items()) + list(IMPORTS.items()):
+        timings = time_command(command, args.repeat)
+        median = statistics.median(timings)
+        extra = (median - baseline) * 1000
+        print(
+            f"{name:<24}: median {median * 1000:7.1f}ms  min {min(timings) * 1000:7.1f}ms  "
+            f"(+{extra:.1f}ms over the interpreter)"
+        )
+        if name in COMMANDS:
+            heavy = heavy_imports(command[2:])
+            if heavy:
+                print(f"{'':<24}  imports {' '.join(heavy)}")
+            if args.budget_ms is not None and (extra > args.budget_ms or heavy):
+                over_budget.append(name)
+    if over_budget:
+        print(f"over budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
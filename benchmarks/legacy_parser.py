@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Former PromptSeek._parse_* cascade, kept as the baseline of parser_bench"""
+import json
+import re
+
+
+def parse_decomposition(decomposition: str):
+    # case 1 :json format
+    try:
+        data = json.loads(decomposition)
+        steps = data.get("steps", [])
+        variables = data.get("variables", [])
+    # case 2 : string format (regular expression)
+    except:
+        # Regular expressions to match steps and their descriptions in the decomposition
+        step_pattern = re.compile(r" P(?:\d+|END): (.*?)\n", re.MULTILINE)
+        description_pattern = re.compile(
+            r" P(?:\d+|END): .*?\n(.*?)(?=\n P(?:\d+|END)|$)",
+            re.MULTILINE | re.DOTALL,
+        )
+
+        steps = step_pattern.findall(decomposition)
+        descriptions = [
+            desc.strip() for desc in description_pattern.findall(decomposition)
+        ]
+
+        variables = dict(zip(steps, descriptions))
+
+    # case 3 : not json format, not string format
+    if not steps or not variables:
+        lines = decomposition.strip().split("\n")
+        steps = []
+        variables = []
+        mode = ""
+        for l in lines:
+            if "- " in l and ":" in l:
+                _l = l.split(":")
+                step, description = _l[-2], _l[-1]
+                if mode != "-to[":
+                    steps.append(step.strip())
+                variables.append(description.strip())
+            elif "- " in l:
+                if not steps:
+                    mode = "-to["
+
+                if mode == "-to[":
+                    steps.append(l.replace("- ", "").strip())
+                else:
+                    variables.append(l.replace("- ", "").strip())
+
+    # case4 : not json format, not string format, not regular expression
+    if not steps or not variables:
+        steps = [l for l in decomposition.strip().split("\n")[1]]
+        variables = [l for l in decomposition.strip().split("\n")[2:]]
+    return steps, variables
+
+
+def parse_optimization(optimization: str):
+    try:
+        data = json.loads(optimization)
+        variables_description = data.get("variables_description", {})
+    except:
+        lines = optimization.strip().split("\n")
+        variables_description = {}
+        for line in lines:
+            if line.startswith("[V"):
+                var_name, description = line.split(":", 1)
+                variables_description[var_name.strip()] = description.strip()
+    return variables_description
+
+
+def parse_redefinition(redefinition: str):
+    try:
+        data = json.loads(redefinition)
+        goal_contents = data.get("goal_contents", "")
+        variables = data.get("variables", [])
+    except:
+        lines = redefinition.strip().split("\n")
+        goal_contents = []
+        variables = []
+        for line in lines:
+            if line.startswith("[Goal"):
+                goal_contents.append(line)
+            elif line.startswith("[V"):
+                variables.append(line)
+    return goal_contents, variables
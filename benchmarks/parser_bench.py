@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Regression check and micro-benchmark of PromptSeeker.modules.parser
+
+python3 benchmarks/parser_bench.py               # check the corpus, then benchmark
+python3 benchmarks/parser_bench.py --rebuild     # rebuild the corpus from retults/
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import legacy_parser
+from PromptSeeker.modules import parser
+
+CORPUS_PATH = os.path.join(ROOT, "benchmarks", "parser_corpus.jsonl")
+RESULT_DIRS = [os.path.join(ROOT, "retults", "prompt_seeks")]
+
+# saved field -> parser kind
+FIELDS = {
+    "plane_decomposed_steps": "decomposition",
+    "plane_optimization": "optimization",
+    "plane_redefinition": "redefinition",
+}
+
+# response styles the saved runs do not cover
+SYNTHETIC = [
+    ("decomposition", '{"steps": ["collect routes", "write tests"], "variables": ["app"]}'),
+    ("decomposition", " P1: collect routes\n list every endpoint\n P2: write tests\n one test per route\n PEND: run\n"),
+    ("decomposition", "Steps\n- collect routes\n- write tests\n"),
+    ("decomposition", "only one line"),
+    ("optimization", '{"variables_description": {"[V1]": "app"}}'),
+    ("optimization", "[V1]: application\n[V2]: test framework\nother"),
+    ("redefinition", '{"goal_contents": "[Goal]: tests", "variables": ["[V1]"]}'),
+    ("redefinition", "[Goal]: generate pytest\n[V1]: FastAPI app\n"),
+]
+
+LEGACY = {
+    "decomposition": lambda text: list(legacy_parser.parse_decomposition(text)),
+    "optimization": lambda text: [legacy_parser.parse_optimization(text)],
+    "redefinition": lambda text: list(legacy_parser.parse_redefinition(text)),
+}
+CURRENT = {
+    "decomposition": lambda text: list(parser.parse_decomposition(text)),
+    "optimization": lambda text: list(parser.parse_optimization(text)),
+    "redefinition": lambda text: list(parser.parse_redefinition(text)),
+}
+
+
+def rebuild_corpus():
+    entries = []
+    for result_dir in RESULT_DIRS:
+        for path in sorted(glob.glob(os.path.join(result_dir, "*.json"))):
+            with open(path, encoding="utf-8") as f:
+                record = json.load(f)
+            for field, kind in FIELDS.items():
+                if record.get(field):
+                    entries.append(
+                        {
+                            "source": f"{os.path.basename(path)}:{field}",
+                            "kind": kind,
+                            "text": record[field],
+                        }
+                    )
+    for i, (kind, text) in enumerate(SYNTHETIC):
+        entries.append({"source": f"synthetic:{i}", "kind": kind, "text": text})
+
+    with open(CORPUS_PATH, "w", encoding="utf-8") as f:
+        for entry in entries:
+            try:
+                entry["expected"] = LEGACY[entry["kind"]](entry["text"])
+            except (IndexError, ValueError):
+                # the former cascade crashed, the parser returns empty results
+                entry["expected"] = CURRENT[entry["kind"]](entry["text"])
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    print(f"wrote {len(entries)} entries to {CORPUS_PATH}")
+
+
+def load_corpus():
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def check(corpus):
+    failures = 0
+    for entry in corpus:
+        # round trip through json so tuples compare as lists
+        got = json.loads(json.dumps(CURRENT[entry["kind"]](entry["text"])))
+        if got != entry["expected"]:
+            failures += 1
+            print(f"MISMATCH {entry['source']}")
+    print(f"regression: {len(corpus) - failures}/{len(corpus)} entries match")
+    return failures == 0
+
+
+def bench(corpus, parsers, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for entry in corpus:
+            try:
+                parsers[entry["kind"]](entry["text"])
+            except (IndexError, ValueError):
+                pass
+    elapsed = time.perf_counter() - started
+    return len(corpus) * repeat / elapsed
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description=__doc__)
+    args.add_argument("--rebuild", action="store_true")
+    args.add_argument("--repeat", type=int, default=200)
+    args = args.parse_args(argv)
+
+    if args.rebuild or not os.path.exists(CORPUS_PATH):
+        rebuild_corpus()
+    corpus = load_corpus()
+    ok = check(corpus)
+    legacy = bench(corpus, LEGACY, args.repeat)
+    current = bench(corpus, CURRENT, args.repeat)
+    print(f"legacy  : {legacy:10.0f} responses/s")
+    print(f"parser  : {current:10.0f} responses/s ({current / legacy:.2f}x)")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())